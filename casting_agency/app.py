@@ -1,12 +1,24 @@
 import os
 import datetime
-from flask import Flask, json, render_template, request, abort, jsonify
+from flask import (Flask, json, render_template, request, abort, jsonify,
+                   Response, stream_with_context)
 from sqlalchemy.sql.operators import endswith_op
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from sqlalchemy.exc import IntegrityError
 
 from .auth import AuthError, requires_auth
-from .models import db, migrate, Movies, Actors
+from .models import db, migrate, Movies, Actors, Roles
+from .matching import matcher
+from .changes import changes_since
+from .events import broker
+from .coalesce import single_flight
+from .catalog import catalog
+from .importer import import_command
+from .audit import audit
+from .schedule import schedule, schedule_constraint_command
+from .ratelimit import (limiter, RateLimitExceeded, Overloaded,
+                        retry_after_header)
 from .config import CastingAgencyConfig
 
 
@@ -27,6 +39,19 @@ def create_app(test_config=None):
 
     db.init_app(app)
     migrate.init_app(app, db)
+    app.config.setdefault('CHANGES_PAGE_SIZE', 500)
+    app.config.setdefault('CHANGES_SETTLE_SECONDS', 5)
+    app.config.setdefault('MAX_BATCH_SIZE', 1000)
+    app.config.setdefault('MAX_PAGE_SIZE', 100)
+    matcher.init_app(app)
+    broker.init_app(app)
+    limiter.init_app(app)
+    single_flight.init_app(app)
+    catalog.init_app(app)
+    audit.init_app(app)
+    schedule.init_app(app)
+    app.cli.add_command(import_command)
+    app.cli.add_command(schedule_constraint_command)
 
     CORS(app)
 
@@ -42,40 +67,165 @@ def create_app(test_config=None):
             'GET,POST,PATCH,DELETE')
         return response
 
+    def notify_change(payload, type, op, record):
+        '''
+        Called by the write handlers after a successful commit.
+        Notifications are best effort, a failing audit log, cache or
+        backend never fails the write that was already committed.
+        '''
+        def attempt(name, effect, *args):
+            try:
+                effect(*args)
+            except Exception:
+                app.logger.exception(
+                    'Failed to update %s after %s %s', name, type, op)
+
+        attempt('the audit log', audit.record, payload, op, type, record.id)
+        if op == 'deleted':
+            # roles may have gone with the deleted row
+            attempt('the schedule', schedule.invalidate)
+        elif type == 'roles':
+            attempt('the schedule', schedule.booked, record)
+        data = None if op == 'deleted' else record.format()
+        if type == 'actors':
+            attempt('the candidate snapshot', matcher.apply,
+                    op, record.id, data)
+        attempt('the catalog read model', catalog.apply,
+                type, op, record.id, data)
+        attempt('event subscribers', broker.publish,
+                type, op, record.id, data)
+
+    def parse_period(start, end):
+        '''two ISO dates, 400 if missing, invalid or out of order'''
+        try:
+            start = datetime.date.fromisoformat(start)
+            end = datetime.date.fromisoformat(end)
+        except (TypeError, ValueError):
+            abort(400)
+        if start > end:
+            abort(400)
+        return start, end
+
+    def json_response(body, status=200):
+        '''Response for a body already serialized, e.g. a coalesced read.'''
+        return Response(body, status, mimetype='application/json')
+
+    def parse_ids(values):
+        '''unique ids in request order, 400 if invalid or too many'''
+        try:
+            ids = list(dict.fromkeys(int(value) for value in values))
+        except (TypeError, ValueError):
+            abort(400)
+        if not ids or len(ids) > app.config['MAX_BATCH_SIZE']:
+            abort(400)
+        return ids
+
+    def fetch_many(model, key, ids):
+        '''fetch many rows with a single IN query, in the order of ids'''
+        def load():
+            rows = {row.id: row
+                    for row in model.query.filter(model.id.in_(ids))}
+            return json.dumps({
+                'success': True,
+                key: [rows[id].format() for id in ids if id in rows],
+                'missing': [id for id in ids if id not in rows]
+            })
+
+        return json_response(single_flight.do((key, tuple(ids)), load))
+
+    def page_args():
+        '''page and per_page query parameters, page is None if absent'''
+        page = request.args.get('page', type=int)
+        per_page = request.args.get('per_page', 20, type=int)
+        if page is not None and (page < 1 or per_page < 1):
+            abort(400)
+        return page, min(per_page, app.config['MAX_PAGE_SIZE'])
+
+    def list_rows(model, key, filters, page, per_page):
+        '''
+        serialized list of rows, from the catalog read model when it is
+        enabled and up to date, otherwise from the database
+        '''
+        body = catalog.serve(key, filters, page, per_page)
+        if body is not None:
+            return json_response(body)
+
+        def load():
+            query = model.query.order_by(model.id)
+            for column, value in filters.items():
+                query = query.filter(getattr(model, column) == value)
+            result = {'success': True}
+            if page is not None:
+                result['total_' + key] = query.count()
+                query = query.limit(per_page).offset((page - 1) * per_page)
+            result[key] = [row.format() for row in query]
+            return json.dumps(result)
+
+        return json_response(single_flight.do(
+            (key, tuple(filters.items()), page, per_page), load))
+
     @app.route('/')
     def index():
         return render_template('index.html')
 
+    @app.route('/metrics', methods=['GET'])
+    @requires_auth('get:metrics')
+    def get_metrics(payload):
+        return jsonify({
+            'success': True,
+            'coalescing': single_flight.stats(),
+            'audit': audit.stats()
+        }), 200
+
     '''
     implement endpoint
     '''
     @app.route('/movies', methods=['GET'], endpoint='get_movies')
     @requires_auth('get:movies')
     def get_movies(payload):
+        if 'ids' in request.args:
+            return fetch_many(
+                Movies, 'movies', parse_ids(request.args['ids'].split(',')))
+
+        filters = {}
+        if 'genres' in request.args:
+            filters['genres'] = request.args['genres']
+        page, per_page = page_args()
+
         try:
-            movies = Movies.query.all()
-            return jsonify({
-                'success': True,
-                'movies': [movie.format() for movie in movies]
-            }), 200
+            return list_rows(Movies, 'movies', filters, page, per_page)
         except BaseException:
             return jsonify({
                 'success': False,
                 'message': 'An error occured'
             }), 500
 
+    @app.route('/movies/batch', methods=['POST'])
+    @requires_auth('get:movies')
+    def get_movies_batch(payload):
+        body = request.get_json() or {}
+        if not isinstance(body, dict) or \
+                not isinstance(body.get('ids'), list):
+            abort(400)
+        return fetch_many(Movies, 'movies', parse_ids(body['ids']))
+
     @app.route('/movies/<id>', methods=['GET'])
     @requires_auth('get:movies')
     def get_movie(payload, id):
-        movie = Movies.query.filter(Movies.id == id).one_or_none()
+        def load():
+            movie = Movies.query.filter(Movies.id == id).one_or_none()
+            if movie:
+                return json.dumps({
+                    'success': True,
+                    'movie': movie.format()
+                })
+
+        body = single_flight.do(('movie', id), load)
         # it should respond with a 404 error if <id> is not found
-        if not movie:
+        if not body:
             abort(404)
         else:
-            return jsonify({
-                'success': True,
-                'movie': movie.format()
-            }), 200
+            return json_response(body)
 
     @app.route('/movies', methods=['POST'], endpoint='create_movies')
     @requires_auth('post:movies')
@@ -95,6 +245,7 @@ def create_app(test_config=None):
                 release_date=new_release_date,
                 genres=new_genres)
             movie.insert()
+            notify_change(payload, 'movies', 'created', movie)
 
             return jsonify({
                 'success': True,
@@ -124,6 +275,7 @@ def create_app(test_config=None):
                 movie.genres = data['genres']
 
             movie.update()
+            notify_change(payload, 'movies', 'updated', movie)
 
             return jsonify({
                 'success': True,
@@ -149,6 +301,7 @@ def create_app(test_config=None):
                 }), 404
 
             movie.delete()
+            notify_change(payload, 'movies', 'deleted', movie)
 
             return jsonify({
                 'success': True,
@@ -158,33 +311,88 @@ def create_app(test_config=None):
         except BaseException:
             abort(422)
 
+    @app.route('/movies/<id>/candidates', methods=['GET'])
+    @requires_auth('get:actors')
+    def get_candidates(payload, id):
+        movie = Movies.query.filter(Movies.id == id).one_or_none()
+        # it should respond with a 404 error if <id> is not found
+        if not movie:
+            abort(404)
+
+        min_age = request.args.get('min_age', type=int)
+        max_age = request.args.get('max_age', type=int)
+        if min_age is not None and max_age is not None and min_age > max_age:
+            abort(400)
+
+        overlap_days = request.args.get('overlap_days', type=int)
+        if overlap_days is not None and not \
+                0 <= overlap_days <= app.config['CANDIDATE_MAX_OVERLAP_DAYS']:
+            abort(400)
+
+        limit = request.args.get('limit', 10, type=int)
+        limit = max(1, min(limit, app.config['CANDIDATE_MAX_RESULTS']))
+
+        total, candidates = matcher.candidates(
+            movie,
+            min_age=min_age,
+            max_age=max_age,
+            gender=request.args.get('gender'),
+            overlap_days=overlap_days,
+            limit=limit)
+
+        return jsonify({
+            'success': True,
+            'movie': movie.id,
+            'candidates': candidates,
+            'total_matches': total
+        }), 200
+
     @app.route('/actors', methods=['GET'], endpoint='actors')
     @requires_auth('get:actors')
     def get_actors(payload):
+        if 'ids' in request.args:
+            return fetch_many(
+                Actors, 'actors', parse_ids(request.args['ids'].split(',')))
+
+        filters = {}
+        if 'gender' in request.args:
+            filters['gender'] = request.args['gender']
+        page, per_page = page_args()
+
         try:
-            actors = Actors.query.all()
-            return jsonify({
-                'success': True,
-                'actors': [actor.format() for actor in actors]
-            }), 200
+            return list_rows(Actors, 'actors', filters, page, per_page)
         except BaseException:
             return jsonify({
                 'success': False,
                 'message': 'An error occured'
             }), 500
 
+    @app.route('/actors/batch', methods=['POST'])
+    @requires_auth('get:actors')
+    def get_actors_batch(payload):
+        body = request.get_json() or {}
+        if not isinstance(body, dict) or \
+                not isinstance(body.get('ids'), list):
+            abort(400)
+        return fetch_many(Actors, 'actors', parse_ids(body['ids']))
+
     @app.route('/actors/<id>', methods=['GET'])
     @requires_auth('get:actors')
     def get_actor(payload, id):
-        actor = Actors.query.filter(Actors.id == id).one_or_none()
+        def load():
+            actor = Actors.query.filter(Actors.id == id).one_or_none()
+            if actor:
+                return json.dumps({
+                    'success': True,
+                    'actor': actor.format()
+                })
+
+        body = single_flight.do(('actor', id), load)
         # it should respond with a 404 error if <id> is not found
-        if not actor:
+        if not body:
             abort(404)
         else:
-            return jsonify({
-                'success': True,
-                'actor': actor.format()
-            }), 200
+            return json_response(body)
 
     @app.route('/actors', methods=['POST'], endpoint='create_actors')
     @requires_auth('post:actors')
@@ -200,6 +408,7 @@ def create_app(test_config=None):
         try:
             actor = Actors(name=new_name, age=new_age, gender=new_gender)
             actor.insert()
+            notify_change(payload, 'actors', 'created', actor)
 
             return jsonify({
                 'success': True,
@@ -229,6 +438,7 @@ def create_app(test_config=None):
                 actor.gender = data['gender']
 
             actor.update()
+            notify_change(payload, 'actors', 'updated', actor)
 
             return jsonify({
                 'success': True,
@@ -254,6 +464,7 @@ def create_app(test_config=None):
                 }), 404
 
             actor.delete()
+            notify_change(payload, 'actors', 'deleted', actor)
 
             return jsonify({
                 'success': True,
@@ -263,6 +474,127 @@ def create_app(test_config=None):
         except BaseException:
             abort(422)
 
+    @app.route('/changes', methods=['GET'])
+    @requires_auth('get:movies')
+    def get_changes(payload):
+        types = ['movies']
+        if 'get:actors' in payload['permissions']:
+            types += ['actors', 'roles']
+
+        limit = request.args.get(
+            'limit', app.config['CHANGES_PAGE_SIZE'], type=int)
+        limit = max(1, min(limit, app.config['CHANGES_PAGE_SIZE']))
+        since = request.args.get('since', '0')
+
+        try:
+            changes, has_more = changes_since(
+                since, limit, types, app.config['CHANGES_SETTLE_SECONDS'])
+        except ValueError:
+            abort(400)
+
+        return jsonify({
+            'success': True,
+            'changes': changes,
+            'cursor': changes[-1]['cursor'] if changes else since,
+            'has_more': has_more
+        }), 200
+
+    @app.route('/events', methods=['GET'])
+    @requires_auth('get:movies')
+    def get_events(payload):
+        types = {'movies'}
+        if 'get:actors' in payload['permissions']:
+            types.update(['actors', 'roles'])
+
+        subscription = broker.subscribe(types)
+        if subscription is None:
+            abort(503)
+        # don't hold a pooled connection for the life of the stream
+        db.session.remove()
+
+        return Response(
+            stream_with_context(broker.stream(subscription)),
+            mimetype='text/event-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            })
+
+    @app.route('/actors/<int:id>/availability', methods=['GET'])
+    @requires_auth('get:actors')
+    def get_availability(payload, id):
+        actor = Actors.query.filter(Actors.id == id).one_or_none()
+        # it should respond with a 404 error if <id> is not found
+        if not actor:
+            abort(404)
+
+        start, end = parse_period(
+            request.args.get('start'), request.args.get('end'))
+        conflicts = schedule.conflicts(actor.id, start, end)
+
+        return jsonify({
+            'success': True,
+            'actor': actor.id,
+            'available': not conflicts,
+            'conflicts': [role.format() for role in conflicts]
+        }), 200
+
+    @app.route('/roles', methods=['POST'])
+    @requires_auth('patch:movies')
+    def create_role(payload):
+        body = request.get_json()
+        if not isinstance(body, dict) or not body.get('role_name'):
+            abort(422)
+
+        actor = Actors.query.filter(
+            Actors.id == body.get('actor_id')).one_or_none()
+        movie = Movies.query.filter(
+            Movies.id == body.get('movie_id')).one_or_none()
+        if not actor or not movie:
+            abort(422)
+
+        shoot_start = shoot_end = None
+        if body.get('shoot_start') or body.get('shoot_end'):
+            shoot_start, shoot_end = parse_period(
+                body.get('shoot_start'), body.get('shoot_end'))
+
+        # no other booking of the actor in this worker can slip between
+        # the check and the insert
+        with schedule.booking(actor.id):
+            if shoot_start:
+                conflicts = schedule.conflicts(
+                    actor.id, shoot_start, shoot_end, fresh=True)
+                if conflicts:
+                    return jsonify({
+                        'success': False,
+                        'error': 409,
+                        'message': 'actor is already booked',
+                        'conflicts': [role.format() for role in conflicts]
+                    }), 409
+
+            role = Roles(
+                actor_id=actor.id,
+                movie_id=movie.id,
+                role_name=body['role_name'],
+                shoot_start=shoot_start,
+                shoot_end=shoot_end)
+            try:
+                role.create()
+            except IntegrityError:
+                # another booking won the race past the exclusion constraint
+                db.session.rollback()
+                return jsonify({
+                    'success': False,
+                    'error': 409,
+                    'message': 'actor is already booked'
+                }), 409
+            notify_change(payload, 'roles', 'created', role)
+
+        return jsonify({
+            'success': True,
+            'role': role.format()
+        }), 200
+
     # Error Handling
 
     @app.errorhandler(422)
@@ -309,6 +641,27 @@ def create_app(test_config=None):
             "message": 'Internal Server Error'
         }), 500
 
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return jsonify({
+            "success": False,
+            "error": 503,
+            "message": 'Service Unavailable'
+        }), 503
+
+    @app.errorhandler(RateLimitExceeded)
+    @app.errorhandler(Overloaded)
+    def rate_limited(error):
+        response = jsonify({
+            "success": False,
+            "error": error.status_code,
+            "message": 'Too Many Requests'
+            if error.status_code == 429 else 'Service Unavailable'
+        })
+        response.headers['Retry-After'] = retry_after_header(
+            error.retry_after)
+        return response, error.status_code
+
     @app.errorhandler(AuthError)
     def auth_error(error):
         return jsonify({
@@ -0,0 +1,163 @@
+import atexit
+import datetime
+import json
+import logging
+import queue
+import threading
+from logging.handlers import RotatingFileHandler
+
+from flask import current_app
+
+from .models import db, AuditLog
+
+
+#----------------------------------------------------------------------------#
+# Audit log.
+#----------------------------------------------------------------------------#
+
+'''
+Write handlers record who changed what after their own commit. Events
+go to a bounded queue that a background thread drains in batches, one
+INSERT (or one file write) per batch, so auditing adds no database
+round trip to the request. When the queue is full events are dropped
+and counted rather than blocking the request. The queue is flushed
+when the process exits.
+'''
+
+
+class DatabaseSink:
+    def __init__(self, app):
+        self.app = app
+
+    def write(self, events):
+        with self.app.app_context():
+            try:
+                db.session.execute(AuditLog.__table__.insert(), events)
+                db.session.commit()
+            finally:
+                db.session.remove()
+
+
+class FileSink:
+    '''JSON lines in a size-rotated local file.'''
+
+    def __init__(self, app):
+        handler = RotatingFileHandler(
+            app.config['AUDIT_FILE'],
+            maxBytes=app.config['AUDIT_FILE_MAX_BYTES'],
+            backupCount=app.config['AUDIT_FILE_BACKUPS'])
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.logger = logging.Logger('casting_agency.audit')
+        self.logger.addHandler(handler)
+
+    def write(self, events):
+        self.logger.info('\n'.join(
+            json.dumps(event, default=str) for event in events))
+
+
+class AuditQueue:
+    def __init__(self, sink, size, batch_size, interval):
+        self.sink = sink
+        self.queue = queue.Queue(maxsize=size)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread = None
+        self.closed = threading.Event()
+        self.counts = {'enqueued': 0, 'written': 0, 'dropped': 0,
+                       'failed': 0}
+
+    def put(self, event):
+        self._start()
+        try:
+            self.queue.put_nowait(event)
+            counter = 'enqueued'
+        except queue.Full:
+            counter = 'dropped'
+        with self.lock:
+            self.counts[counter] += 1
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None and not self.closed.is_set():
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while not (self.closed.is_set() and self.queue.empty()):
+            try:
+                batch = [self.queue.get(timeout=self.interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.sink.write(batch)
+                self.counts['written'] += len(batch)
+            except Exception:
+                self.counts['failed'] += len(batch)
+                logging.getLogger(__name__).exception(
+                    'Failed to write %d audit events', len(batch))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def flush(self):
+        '''block until every event queued so far is written'''
+        if self.thread is not None:
+            self.queue.join()
+
+    def close(self, timeout=10):
+        self.closed.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+
+class AuditLogger:
+
+    def init_app(self, app):
+        app.config.setdefault('AUDIT_ENABLED', True)
+        app.config.setdefault('AUDIT_SINK', 'database')
+        app.config.setdefault('AUDIT_FILE', 'audit.log')
+        app.config.setdefault('AUDIT_FILE_MAX_BYTES', 10 * 1024 * 1024)
+        app.config.setdefault('AUDIT_FILE_BACKUPS', 5)
+        app.config.setdefault('AUDIT_QUEUE_SIZE', 10000)
+        app.config.setdefault('AUDIT_BATCH_SIZE', 500)
+        app.config.setdefault('AUDIT_FLUSH_INTERVAL', 1.0)
+
+        if app.config['AUDIT_SINK'] == 'file':
+            sink = FileSink(app)
+        else:
+            sink = DatabaseSink(app)
+        audit_queue = AuditQueue(
+            sink,
+            app.config['AUDIT_QUEUE_SIZE'],
+            app.config['AUDIT_BATCH_SIZE'],
+            app.config['AUDIT_FLUSH_INTERVAL'])
+        app.extensions['audit'] = audit_queue
+        atexit.register(audit_queue.close)
+
+    def record(self, payload, action, entity, entity_id):
+        '''Queue an audit event for a write made with this token.'''
+        if not current_app.config['AUDIT_ENABLED']:
+            return
+        current_app.extensions['audit'].put({
+            'subject': payload.get('sub'),
+            'action': action,
+            'entity': entity,
+            'entity_id': entity_id,
+            'occurred_at': datetime.datetime.utcnow()
+        })
+
+    def flush(self):
+        current_app.extensions['audit'].flush()
+
+    def stats(self):
+        audit_queue = current_app.extensions['audit']
+        return dict(audit_queue.counts, queued=audit_queue.queue.qsize())
+
+
+audit = AuditLogger()
@@ -6,6 +6,8 @@ from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
 
+from .ratelimit import limiter
+
 '''
 AUTH0_DOMAIN = 'xiaohan.us.auth0.com'
 API_AUDIENCE = 'casting_agency'
@@ -172,6 +174,7 @@ def requires_auth(permission=''):
                 abort(401)
 
             check_permissions(permission, payload)
+            limiter.check(permission, payload)
             return f(payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
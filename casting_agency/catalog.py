@@ -0,0 +1,234 @@
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from flask import current_app, json
+
+from .models import Movies, Actors
+from .changes import changes_since, head_cursor
+
+
+#----------------------------------------------------------------------------#
+# In-memory catalog read model.
+#----------------------------------------------------------------------------#
+
+'''
+An optional copy of the movies and actors tables that serves the list
+endpoints without touching the database. It is loaded on the first
+read, updated by this worker's write handlers and caught up with
+other workers' writes through the change feed once it is older than
+CATALOG_MAX_STALENESS seconds. If catching up fails the caller falls
+back to the database.
+Loading and catching up query the database without holding the lock
+that list requests and write handlers take, one request at a time does
+it while the others keep serving the current copy. Changes applied in
+the meantime are replayed on the result.
+Every row keeps its serialized JSON so a list response is a join of
+ready-made strings, and the ids of the rows with each filter value are
+kept in order so a filtered page needs no scan.
+'''
+
+
+class MovieRow:
+    __slots__ = ('id', 'genres', 'json')
+    filters = ('genres',)
+
+
+class ActorRow:
+    __slots__ = ('id', 'gender', 'json')
+    filters = ('gender',)
+
+
+class TableSnapshot:
+    def __init__(self, row_type):
+        self.row_type = row_type
+        self.rows = {}
+        # ids in ascending order, the order the database lists rows in
+        self.ids = array('q')
+        # filter field -> value -> ids in ascending order
+        self.index = {field: {} for field in row_type.filters}
+
+    def _add(self, ids, id):
+        ids.insert(bisect_left(ids, id), id)
+
+    def _discard(self, ids, id):
+        del ids[bisect_left(ids, id)]
+
+    def _index(self, row):
+        for field in row.filters:
+            self._add(self.index[field].setdefault(
+                getattr(row, field), array('q')), row.id)
+
+    def _unindex(self, row):
+        for field in row.filters:
+            ids = self.index[field][getattr(row, field)]
+            self._discard(ids, row.id)
+            if not ids:
+                del self.index[field][getattr(row, field)]
+
+    def put(self, data):
+        row = self.row_type()
+        row.id = data['id']
+        for field in row.filters:
+            setattr(row, field, data[field])
+        row.json = json.dumps(data)
+        previous = self.rows.get(row.id)
+        if previous is None:
+            self._add(self.ids, row.id)
+        else:
+            self._unindex(previous)
+        self.rows[row.id] = row
+        self._index(row)
+
+    def remove(self, id):
+        row = self.rows.pop(id, None)
+        if row is not None:
+            self._discard(self.ids, id)
+            self._unindex(row)
+
+    def select(self, filters, page, per_page):
+        '''Return (total, serialized rows) for a filtered page.'''
+        ids = self.ids
+        for position, (field, value) in enumerate(filters.items()):
+            if position == 0:
+                ids = self.index[field].get(value, ())
+            else:
+                ids = [id for id in ids
+                       if getattr(self.rows[id], field) == value]
+        total = len(ids)
+        if page is not None:
+            start = (page - 1) * per_page
+            ids = ids[start:start + per_page]
+        return total, [self.rows[id].json for id in ids]
+
+
+class CatalogReadModel:
+    models = {'movies': (Movies, MovieRow), 'actors': (Actors, ActorRow)}
+
+    def init_app(self, app):
+        app.config.setdefault('CATALOG_READ_MODEL', False)
+        app.config.setdefault('CATALOG_MAX_STALENESS', 5)
+        app.extensions['catalog_read_model'] = {
+            'tables': None,
+            'cursor': None,
+            'synced_at': 0.0,
+            # changes applied during a refresh, None when not refreshing
+            'pending': None,
+            # guards reads and changes of the tables
+            'lock': threading.Lock(),
+            # held by the one request loading or catching up
+            'refresh': threading.Lock()
+        }
+
+    def _state(self):
+        return current_app.extensions['catalog_read_model']
+
+    def _load(self):
+        '''Return (tables, cursor) read from the database.'''
+        cursor = head_cursor(current_app.config['CHANGES_SETTLE_SECONDS'])
+        tables = {}
+        for key, (model, row_type) in self.models.items():
+            tables[key] = TableSnapshot(row_type)
+            for record in model.query.order_by(model.id):
+                tables[key].put(record.format())
+        return tables, cursor
+
+    def _changes(self, cursor):
+        '''Return (changes, cursor) for everything after cursor.'''
+        page_size = current_app.config['CHANGES_PAGE_SIZE']
+        changes = []
+        has_more = True
+        while has_more:
+            page, has_more = changes_since(
+                cursor, page_size, list(self.models),
+                current_app.config['CHANGES_SETTLE_SECONDS'])
+            changes += page
+            if page:
+                cursor = page[-1]['cursor']
+        return changes, cursor
+
+    def _change(self, tables, key, op, id, data):
+        if op == 'deleted':
+            tables[key].remove(id)
+        else:
+            tables[key].put(data)
+
+    def _refresh(self, state):
+        '''called with the refresh lock held'''
+        with state['lock']:
+            state['pending'] = []
+        try:
+            if state['tables'] is None:
+                tables, cursor = self._load()
+                changes = []
+            else:
+                tables = None
+                changes, cursor = self._changes(state['cursor'])
+        except Exception:
+            with state['lock']:
+                state['pending'] = None
+            raise
+
+        with state['lock']:
+            if tables is not None:
+                state['tables'] = tables
+            for change in changes:
+                self._change(
+                    state['tables'], change['type'],
+                    'deleted' if change['op'] == 'delete' else 'updated',
+                    change['id'], change.get('data'))
+            for key, op, id, data in state['pending']:
+                self._change(state['tables'], key, op, id, data)
+            state['pending'] = None
+            state['cursor'] = cursor
+            state['synced_at'] = time.monotonic()
+
+    def apply(self, key, op, id, data=None):
+        '''Called by the write handlers after a commit.'''
+        if key not in self.models:
+            return
+        state = self._state()
+        with state['lock']:
+            if state['pending'] is not None:
+                state['pending'].append((key, op, id, data))
+            if state['tables'] is not None:
+                self._change(state['tables'], key, op, id, data)
+
+    def serve(self, key, filters, page, per_page):
+        '''
+        Return the serialized list response, or None when the read
+        model is disabled or can't be brought up to date.
+        '''
+        if not current_app.config['CATALOG_READ_MODEL']:
+            return None
+
+        state = self._state()
+        try:
+            if state['tables'] is None:
+                with state['refresh']:
+                    if state['tables'] is None:
+                        self._refresh(state)
+            elif time.monotonic() - state['synced_at'] > \
+                    current_app.config['CATALOG_MAX_STALENESS'] and \
+                    state['refresh'].acquire(blocking=False):
+                try:
+                    self._refresh(state)
+                finally:
+                    state['refresh'].release()
+        except Exception:
+            current_app.logger.exception('Catalog read model is stale')
+            return None
+
+        with state['lock']:
+            total, rows = state['tables'][key].select(
+                filters, page, per_page)
+
+        # same layout as json.dumps with sorted keys
+        body = '{"%s": [%s], "success": true' % (key, ', '.join(rows))
+        if page is not None:
+            body += ', "total_%s": %d' % (key, total)
+        return body + '}'
+
+
+catalog = CatalogReadModel()
@@ -0,0 +1,133 @@
+import datetime
+
+from sqlalchemy import and_, or_
+
+from .models import db, utcnow, Movies, Actors, Roles, Tombstones
+
+
+#----------------------------------------------------------------------------#
+# Change feed.
+#----------------------------------------------------------------------------#
+
+'''
+Every feed is scanned in (timestamp, id) order through its index.
+A cursor is "<microseconds since epoch>-<feed>-<id>" of the last change
+a client has seen, the feed number breaks ties between rows of different
+tables that share a timestamp so the merged order is total.
+Timestamps are taken by the database when a row is written, which is
+not the order transactions commit in: a row stamped before a cursor can
+still become visible after it. Reads therefore stop at a horizon
+settle seconds behind the database clock, changes younger than that
+are returned by a later call.
+'''
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+FEEDS = (
+    ('movies', Movies, Movies.updated_at),
+    ('actors', Actors, Actors.updated_at),
+    ('roles', Roles, Roles.updated_at),
+    ('deleted', Tombstones, Tombstones.deleted_at),
+)
+
+
+def encode_cursor(timestamp, feed, id):
+    return '{}-{}-{}'.format((timestamp - EPOCH) // MICROSECOND, feed, id)
+
+
+def decode_cursor(cursor):
+    '''
+    Return (timestamp, feed, id) for a cursor, "0" or an empty cursor
+    start from the beginning. Raises ValueError on a malformed cursor.
+    '''
+    if not cursor or cursor == '0':
+        return EPOCH, -1, 0
+    micros, feed, id = (int(part) for part in cursor.split('-'))
+    try:
+        return EPOCH + micros * MICROSECOND, feed, id
+    except OverflowError:
+        raise ValueError('cursor out of range')
+
+
+def _after(feed, column, model, cursor):
+    '''filter for rows of one feed that sort after the cursor'''
+    timestamp, cursor_feed, cursor_id = cursor
+    if feed > cursor_feed:
+        return column >= timestamp
+    if feed < cursor_feed:
+        return column > timestamp
+    return or_(column > timestamp,
+               and_(column == timestamp, model.id > cursor_id))
+
+
+def _entry(feed, name, row, timestamp):
+    if name == 'deleted':
+        change = {
+            'type': row.entity,
+            'op': 'delete',
+            'id': row.entity_id
+        }
+    else:
+        change = {
+            'type': name,
+            'op': 'upsert',
+            'id': row.id,
+            'data': row.format()
+        }
+    change['timestamp'] = timestamp.isoformat()
+    change['cursor'] = encode_cursor(timestamp, feed, row.id)
+    return change
+
+
+def horizon(settle):
+    '''database time before which every change is taken as committed'''
+    return db.session.query(utcnow()).scalar() - \
+        datetime.timedelta(seconds=settle)
+
+
+def changes_since(cursor, limit, types=None, settle=0):
+    '''
+    Return (changes, has_more) for everything modified after cursor and
+    more than settle seconds ago.
+    Each feed reads at most limit + 1 rows, the results are merged in
+    cursor order and cut at limit. types restricts the entity types
+    returned, e.g. to what the caller has permission to read.
+    '''
+    position = decode_cursor(cursor)
+    before = horizon(settle)
+    merged = []
+    for feed, (name, model, column) in enumerate(FEEDS):
+        query = model.query.filter(
+            _after(feed, column, model, position), column < before)
+        if types is not None:
+            if name == 'deleted':
+                query = query.filter(Tombstones.entity.in_(types))
+            elif name not in types:
+                continue
+        rows = query.order_by(column, model.id).limit(limit + 1).all()
+        for row in rows:
+            timestamp = getattr(row, column.key)
+            merged.append(((timestamp, feed, row.id), feed, name, row))
+
+    merged.sort(key=lambda change: change[0])
+    has_more = len(merged) > limit
+    return [_entry(feed, name, row, key[0])
+            for key, feed, name, row in merged[:limit]], has_more
+
+
+def head_cursor(settle=0):
+    '''
+    cursor of the most recent change more than settle seconds ago, "0"
+    when there are none
+    '''
+    before = horizon(settle)
+    latest = None
+    for feed, (name, model, column) in enumerate(FEEDS):
+        row = model.query.with_entities(column, model.id).filter(
+            column < before).order_by(
+            column.desc(), model.id.desc()).first()
+        if row is not None and (latest is None or
+                                (row[0], feed, row[1]) > latest):
+            latest = (row[0], feed, row[1])
+    return encode_cursor(*latest) if latest else '0'
@@ -0,0 +1,75 @@
+import threading
+
+from flask import current_app
+
+
+#----------------------------------------------------------------------------#
+# Request coalescing.
+#----------------------------------------------------------------------------#
+
+'''
+Identical reads that arrive while one is already running wait for it
+and share its result instead of running their own query. Nothing is
+kept once the running call finishes, so a read never returns data older
+than a read that was in flight when it arrived.
+'''
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+
+    def init_app(self, app):
+        app.extensions['single_flight'] = {
+            'calls': {},
+            'lock': threading.Lock(),
+            'executed': 0,
+            'coalesced': 0
+        }
+
+    def do(self, key, fn):
+        '''
+        Run fn and return its result, unless a call with the same key
+        is in flight in this worker, then wait for and return its result.
+        '''
+        state = current_app.extensions['single_flight']
+        with state['lock']:
+            call = state['calls'].get(key)
+            leader = call is None
+            if leader:
+                call = state['calls'][key] = Call()
+                state['executed'] += 1
+            else:
+                state['coalesced'] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with state['lock']:
+                del state['calls'][key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        state = current_app.extensions['single_flight']
+        return {
+            'executed': state['executed'],
+            'coalesced': state['coalesced']
+        }
+
+
+single_flight = SingleFlight()
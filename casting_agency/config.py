@@ -9,3 +9,7 @@ class CastingAgencyConfig:
     # Connect to the database
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # threads per gunicorn worker, keep in step with --threads in the
+    # Procfile
+    WEB_THREADS = int(os.environ.get('WEB_THREADS', 16))
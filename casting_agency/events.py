@@ -0,0 +1,194 @@
+import json
+import queue
+import select
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import text
+
+from .models import db
+
+
+#----------------------------------------------------------------------------#
+# Catalog change notifications.
+#----------------------------------------------------------------------------#
+
+'''
+Write handlers publish a notification for every create, update and
+delete. A backend carries notifications to every worker, each worker
+then fans them out to the subscribers of its /events stream.
+Every subscriber has a bounded queue. A subscriber whose queue fills up
+is dropped and told so with an "overflow" event; it should resync from
+/changes and reconnect, so one slow client never holds unbounded memory.
+'''
+
+
+class LocalBackend:
+    '''Delivers notifications to subscribers of this process only.'''
+
+    def start(self, dispatch):
+        self.dispatch = dispatch
+
+    def publish(self, type, op, message):
+        self.dispatch(type, op, message)
+
+
+class PostgresBackend:
+    '''
+    Delivers notifications to every worker through Postgres
+    LISTEN/NOTIFY. The listening connection is taken out of the pool on
+    the first publish or subscription, so it is never shared.
+    '''
+    channel = 'casting_agency_events'
+    # NOTIFY payloads are limited to 8000 bytes
+    max_payload = 7900
+
+    def start(self, dispatch):
+        self.dispatch = dispatch
+        self.engine = db.engine
+        thread = threading.Thread(target=self._listen, daemon=True)
+        thread.start()
+
+    def publish(self, type, op, message):
+        if len(message.encode('utf-8')) > self.max_payload:
+            # receivers only learn which row changed and can fetch it
+            data = json.loads(message)
+            data.pop('data', None)
+            message = json.dumps(data)
+        with self.engine.begin() as conn:
+            conn.execute(text('SELECT pg_notify(:channel, :message)'),
+                         channel=self.channel, message=message)
+
+    def _listen(self):
+        while True:
+            conn = None
+            try:
+                conn = self.engine.raw_connection()
+                conn.detach()
+                conn.set_session(autocommit=True)
+                with conn.cursor() as cursor:
+                    cursor.execute('LISTEN ' + self.channel)
+                while True:
+                    if select.select([conn], [], [], 30) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        data = json.loads(notify.payload)
+                        self.dispatch(data['type'], data['op'],
+                                      notify.payload)
+            except Exception:
+                # reconnect after the database goes away, the detached
+                # connection is not returned to the pool so close it
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                time.sleep(1)
+
+
+class Subscription:
+    def __init__(self, types, size):
+        self.types = types
+        self.queue = queue.Queue(maxsize=size)
+        self.overflowed = False
+
+
+class EventBroker:
+
+    def init_app(self, app):
+        app.config.setdefault('EVENTS_BACKEND', 'local')
+        app.config.setdefault('EVENTS_QUEUE_SIZE', 100)
+        # every open stream holds one of the worker's threads, a quarter
+        # of them at most so ordinary requests are still served
+        app.config.setdefault('WEB_THREADS', 16)
+        app.config.setdefault('EVENTS_MAX_SUBSCRIBERS',
+                              max(1, app.config['WEB_THREADS'] // 4))
+        app.config.setdefault('EVENTS_HEARTBEAT', 15)
+
+        if app.config['EVENTS_BACKEND'] == 'postgres':
+            backend = PostgresBackend()
+        else:
+            backend = LocalBackend()
+
+        app.extensions['event_broker'] = {
+            'backend': backend,
+            'started': False,
+            'subscribers': set(),
+            'lock': threading.Lock()
+        }
+
+    def _state(self):
+        return current_app.extensions['event_broker']
+
+    def publish(self, type, op, id, data=None):
+        message = json.dumps({
+            'type': type,
+            'op': op,
+            'id': id,
+            'data': data
+        }, cls=current_app.json_encoder)
+        self._start()
+        self._state()['backend'].publish(type, op, message)
+
+    def _start(self):
+        state = self._state()
+        with state['lock']:
+            if not state['started']:
+                state['backend'].start(
+                    lambda type, op, message:
+                        self._dispatch(state, type, op, message))
+                state['started'] = True
+
+    def _dispatch(self, state, type, op, message):
+        with state['lock']:
+            subscribers = list(state['subscribers'])
+        for subscription in subscribers:
+            if type not in subscription.types:
+                continue
+            try:
+                subscription.queue.put_nowait((op, message))
+            except queue.Full:
+                subscription.overflowed = True
+                self._unsubscribe(state, subscription)
+
+    def _unsubscribe(self, state, subscription):
+        with state['lock']:
+            state['subscribers'].discard(subscription)
+
+    def subscribe(self, types):
+        '''Return a new Subscription, or None when the worker is full.'''
+        self._start()
+        state = self._state()
+        subscription = Subscription(
+            types, current_app.config['EVENTS_QUEUE_SIZE'])
+        with state['lock']:
+            if len(state['subscribers']) >= \
+                    current_app.config['EVENTS_MAX_SUBSCRIBERS']:
+                return None
+            state['subscribers'].add(subscription)
+        return subscription
+
+    def stream(self, subscription):
+        '''Generate the text/event-stream body for a subscription.'''
+        state = self._state()
+        heartbeat = current_app.config['EVENTS_HEARTBEAT']
+        try:
+            yield ': connected\n\n'
+            while True:
+                if subscription.overflowed:
+                    yield 'event: overflow\ndata: {}\n\n'
+                    return
+                try:
+                    op, message = subscription.queue.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield 'event: {}\ndata: {}\n\n'.format(op, message)
+        finally:
+            self._unsubscribe(state, subscription)
+
+
+broker = EventBroker()
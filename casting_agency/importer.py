@@ -0,0 +1,258 @@
+import csv
+import datetime
+import io
+import json
+import time
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy.exc import DataError, DBAPIError, IntegrityError
+
+from .models import db, Movies, Actors, Roles
+
+
+#----------------------------------------------------------------------------#
+# Bulk import.
+#----------------------------------------------------------------------------#
+
+'''
+flask import <movies|actors|roles> FILE
+
+Streams a CSV file (with a header row) or an NDJSON file, validates it
+in chunks and writes every chunk with one COPY on Postgres, or one
+executemany INSERT on other databases. Roles refer to their actor and
+movie either by id (actor_id, movie_id) or by name (actor, movie).
+Imported roles are not checked for double bookings, except by the
+Postgres exclusion constraint. A chunk the database rejects is rolled
+back, reported with its line range and skipped as a whole.
+Created rows show up in /changes, running workers pick them up through
+the change feed and snapshot refreshes.
+'''
+
+
+def read_csv(file):
+    for line, row in enumerate(csv.DictReader(file), start=2):
+        yield line, row
+
+
+def read_ndjson(file):
+    '''yields None for lines that are not a json object'''
+    for line, text in enumerate(file, start=1):
+        if text.strip():
+            try:
+                row = json.loads(text)
+            except ValueError:
+                row = None
+            yield line, row if isinstance(row, dict) else None
+
+
+def scalar(row, field):
+    '''the value of a field, NDJSON rows can hold lists and objects'''
+    value = row.get(field)
+    if isinstance(value, (list, dict)):
+        raise ValueError('invalid {}'.format(field))
+    return value
+
+
+def required(row, field, max_length=None):
+    value = scalar(row, field)
+    if value is None or not str(value).strip():
+        raise ValueError('missing {}'.format(field))
+    value = str(value).strip()
+    if max_length and len(value) > max_length:
+        raise ValueError('{} is longer than {}'.format(field, max_length))
+    return value
+
+
+def parse_movie(row):
+    release_date = required(row, 'release_date')
+    try:
+        release_date = datetime.date.fromisoformat(release_date[:10])
+    except ValueError:
+        raise ValueError('invalid release_date')
+    return {
+        'name': required(row, 'name', 500),
+        'release_date': release_date,
+        'genres': required(row, 'genres', 500)
+    }
+
+
+def parse_actor(row):
+    try:
+        age = int(required(row, 'age'))
+    except ValueError:
+        raise ValueError('invalid age')
+    if age < 0:
+        raise ValueError('invalid age')
+    return {
+        'name': required(row, 'name', 500),
+        'age': age,
+        'gender': required(row, 'gender', 120)
+    }
+
+
+def parse_role(row):
+    role = {
+        'role_name': required(row, 'role_name', 120),
+        'shoot_start': None,
+        'shoot_end': None
+    }
+    for field in ('shoot_start', 'shoot_end'):
+        if scalar(row, field) not in (None, ''):
+            try:
+                role[field] = datetime.date.fromisoformat(str(row[field]))
+            except ValueError:
+                raise ValueError('invalid {}'.format(field))
+    if (role['shoot_start'] is None) != (role['shoot_end'] is None) or \
+            (role['shoot_start'] and role['shoot_start'] > role['shoot_end']):
+        raise ValueError('invalid shooting dates')
+    for field in ('actor', 'movie'):
+        if scalar(row, field + '_id') not in (None, ''):
+            try:
+                role[field + '_id'] = int(row[field + '_id'])
+            except ValueError:
+                raise ValueError('invalid {}_id'.format(field))
+        else:
+            role[field] = required(row, field)
+    return role
+
+
+def resolve_references(rows):
+    '''
+    Replace actor/movie names by ids and check referenced ids exist,
+    with one query per table for the whole chunk.
+    Returns the rows that could not be resolved with an error message.
+    '''
+    invalid = []
+    for field, model in (('actor', Actors), ('movie', Movies)):
+        key = field + '_id'
+        names = {row[field] for line, row in rows if field in row}
+        ids = {row[key] for line, row in rows if key in row}
+        by_name = {}
+        if names:
+            for id, name in db.session.query(model.id, model.name).filter(
+                    model.name.in_(names)).order_by(model.id.desc()):
+                by_name[name] = id
+        existing = set()
+        if ids:
+            existing = {id for id, in db.session.query(model.id).filter(
+                model.id.in_(ids))}
+        for line, row in rows:
+            if field in row:
+                name = row.pop(field)
+                if name in by_name:
+                    row[key] = by_name[name]
+                else:
+                    invalid.append((line, 'unknown {} {}'.format(field, name)))
+            elif row[key] not in existing:
+                invalid.append((line, 'unknown {} {}'.format(key, row[key])))
+    bad = {line for line, error in invalid}
+    rows[:] = [(line, row) for line, row in rows if line not in bad]
+    return invalid
+
+
+def copy_rows(model, columns, rows):
+    '''write rows with COPY FROM STDIN through the session's connection'''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[column] for column in columns])
+    buffer.seek(0)
+    statement = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        model.__tablename__, ', '.join(columns))
+    connection = db.session.connection()
+    dbapi = connection.dialect.dbapi
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(statement, buffer)
+    except dbapi.Error as error:
+        # raise the same exception an executed statement would
+        raise DBAPIError.instance(statement, None, error, dbapi.Error)
+    finally:
+        cursor.close()
+
+
+def insert_rows(model, columns, rows):
+    db.session.execute(model.__table__.insert(), rows)
+
+
+ENTITIES = {
+    'movies': (Movies, parse_movie, ('name', 'release_date', 'genres')),
+    'actors': (Actors, parse_actor, ('name', 'age', 'gender')),
+    'roles': (Roles, parse_role, ('actor_id', 'movie_id', 'role_name',
+                                  'shoot_start', 'shoot_end'))
+}
+
+
+@click.command('import')
+@click.argument('entity', type=click.Choice(list(ENTITIES)))
+@click.argument('file', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'ndjson']),
+              help='File format, guessed from the file extension by default.')
+@click.option('--chunk-size', default=5000, show_default=True,
+              help='Rows validated and written per transaction.')
+@click.option('--strict', is_flag=True,
+              help='Stop at the first invalid row instead of skipping it.')
+@with_appcontext
+def import_command(entity, file, file_format, chunk_size, strict):
+    '''Bulk import movies, actors or roles from a CSV or NDJSON file.'''
+    model, parse, columns = ENTITIES[entity]
+    if file_format is None:
+        file_format = 'ndjson' if file.name.endswith(
+            ('.ndjson', '.jsonl')) else 'csv'
+    reader = read_ndjson(file) if file_format == 'ndjson' else read_csv(file)
+    write = copy_rows if db.engine.dialect.name == 'postgresql' \
+        else insert_rows
+
+    start = time.monotonic()
+    imported = skipped = 0
+
+    def flush(chunk):
+        invalid = resolve_references(chunk) if entity == 'roles' else []
+        report(invalid)
+        # created_at and updated_at are stamped by the database
+        rows = [row for line, row in chunk]
+        if not rows:
+            return 0, len(invalid)
+        try:
+            write(model, columns, rows)
+            db.session.commit()
+        except (IntegrityError, DataError) as error:
+            db.session.rollback()
+            click.echo('lines {}-{}: chunk rejected, {}'.format(
+                chunk[0][0], chunk[-1][0], error.orig), err=True)
+            if strict:
+                raise click.ClickException('chunk rejected, import stopped')
+            return 0, len(invalid) + len(rows)
+        return len(rows), len(invalid)
+
+    def report(invalid):
+        for line, error in invalid:
+            click.echo('line {}: {}'.format(line, error), err=True)
+        if invalid and strict:
+            db.session.rollback()
+            raise click.ClickException('invalid row, import stopped')
+
+    chunk = []
+    for line, row in reader:
+        try:
+            if row is None:
+                raise ValueError('not a json object')
+            chunk.append((line, parse(row)))
+        except ValueError as error:
+            report([(line, str(error))])
+            skipped += 1
+        if len(chunk) >= chunk_size:
+            written, invalid = flush(chunk)
+            imported += written
+            skipped += invalid
+            chunk = []
+    written, invalid = flush(chunk)
+    imported += written
+    skipped += invalid
+
+    elapsed = time.monotonic() - start
+    click.echo('Imported {} {} in {:.1f}s ({:.0f} rows/sec), '
+               '{} invalid rows skipped'.format(
+                   imported, entity, elapsed,
+                   imported / elapsed if elapsed else 0, skipped))
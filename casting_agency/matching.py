@@ -0,0 +1,263 @@
+import datetime
+import threading
+import time
+
+import numpy as np
+from flask import current_app
+
+from .models import db, Movies, Actors, Roles
+
+
+#----------------------------------------------------------------------------#
+# Casting match engine.
+#----------------------------------------------------------------------------#
+
+class ActorSnapshot:
+    '''
+    Columnar copy of the actors table.
+    Each attribute is a NumPy array indexed by row so a whole role
+    search is a handful of vectorized comparisons instead of a
+    query plus a Python loop per actor. Arrays keep spare capacity so
+    the write handlers can apply a single actor change in place, only
+    the first size rows are in use.
+    '''
+
+    def __init__(self, rows):
+        self.size = len(rows)
+        capacity = max(16, self.size * 2)
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.ages = np.zeros(capacity, dtype=np.int32)
+        self.gender_codes = np.zeros(capacity, dtype=np.int32)
+        self.names = np.empty(capacity, dtype=object)
+        self.genders = np.empty(capacity, dtype=object)
+        # store gender as small integer codes so filtering never
+        # compares strings row by row
+        self.gender_values = {}
+
+        self.ids[:self.size] = [r.id for r in rows]
+        self.ages[:self.size] = [r.age for r in rows]
+        self.gender_codes[:self.size] = [self._code(r.gender) for r in rows]
+        self.names[:self.size] = [r.name for r in rows]
+        self.genders[:self.size] = [r.gender for r in rows]
+        # actor id -> row
+        self.rows = {id: row for row, id in
+                     enumerate(self.ids[:self.size].tolist())}
+        self.built_at = time.monotonic()
+
+    def __len__(self):
+        return self.size
+
+    def _code(self, gender):
+        return self.gender_values.setdefault(
+            gender.lower(), len(self.gender_values))
+
+    def gender_code(self, gender):
+        return self.gender_values.get(gender.lower())
+
+    def _grow(self):
+        for name in ('ids', 'ages', 'gender_codes', 'names', 'genders'):
+            column = getattr(self, name)
+            grown = np.empty(len(column) * 2, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            setattr(self, name, grown)
+
+    def put(self, data):
+        '''insert or update the row of one actor'''
+        # convert first so a bad value leaves the snapshot unchanged
+        age = int(data['age'])
+        code = self._code(data['gender'])
+        row = self.rows.get(data['id'])
+        if row is None:
+            if self.size == len(self.ids):
+                self._grow()
+            row = self.rows[data['id']] = self.size
+            self.size += 1
+        self.ids[row] = data['id']
+        self.ages[row] = age
+        self.gender_codes[row] = code
+        self.names[row] = data['name']
+        self.genders[row] = data['gender']
+
+    def remove(self, id):
+        '''drop the row of one actor, the last row takes its place'''
+        row = self.rows.pop(id, None)
+        if row is None:
+            return
+        last = self.size - 1
+        if row != last:
+            for column in (self.ids, self.ages, self.gender_codes,
+                           self.names, self.genders):
+                column[row] = column[last]
+            self.rows[int(self.ids[row])] = row
+        self.names[last] = self.genders[last] = None
+        self.size = last
+
+
+class CastingMatcher:
+    '''
+    Ranks actors against role criteria using an ActorSnapshot.
+    The actor write handlers apply their change to the snapshot, it is
+    only reloaded once older than CANDIDATE_SNAPSHOT_TTL seconds so
+    writes made by other workers are eventually picked up. Changes
+    applied while a reload reads the table are replayed on the new
+    snapshot, the read may have started before they were committed.
+    '''
+
+    def init_app(self, app):
+        app.config.setdefault('CANDIDATE_SNAPSHOT_TTL', 60)
+        app.config.setdefault('CANDIDATE_OVERLAP_DAYS', 90)
+        app.config.setdefault('CANDIDATE_MAX_OVERLAP_DAYS', 3650)
+        app.config.setdefault('CANDIDATE_MAX_RESULTS', 100)
+        app.extensions['casting_matcher'] = {
+            'snapshot': None,
+            # changes applied during a reload, None when not reloading
+            'pending': None,
+            # guards reads and changes of the snapshot arrays
+            'lock': threading.Lock(),
+            # held by the one request reloading the snapshot
+            'reload': threading.Lock()
+        }
+
+    def _state(self):
+        return current_app.extensions['casting_matcher']
+
+    def _change(self, snapshot, op, id, data):
+        if op == 'deleted':
+            snapshot.remove(id)
+        else:
+            snapshot.put(data)
+
+    def apply(self, op, id, data=None):
+        '''Called by the actor write handlers after a commit.'''
+        state = self._state()
+        with state['lock']:
+            if state['pending'] is not None:
+                state['pending'].append((op, id, data))
+            if state['snapshot'] is not None:
+                self._change(state['snapshot'], op, id, data)
+
+    def _load(self):
+        rows = db.session.query(
+            Actors.id, Actors.name, Actors.age, Actors.gender).all()
+        return ActorSnapshot(rows)
+
+    def _reload(self, state):
+        '''called with the reload lock held'''
+        with state['lock']:
+            state['pending'] = []
+        try:
+            snapshot = self._load()
+        except Exception:
+            with state['lock']:
+                state['pending'] = None
+            raise
+        with state['lock']:
+            for op, id, data in state['pending']:
+                self._change(snapshot, op, id, data)
+            state['pending'] = None
+            state['snapshot'] = snapshot
+
+    def snapshot(self):
+        state = self._state()
+        snapshot = state['snapshot']
+        if snapshot is None:
+            with state['reload']:
+                if state['snapshot'] is None:
+                    self._reload(state)
+                return state['snapshot']
+
+        ttl = current_app.config['CANDIDATE_SNAPSHOT_TTL']
+        if time.monotonic() - snapshot.built_at >= ttl and \
+                state['reload'].acquire(blocking=False):
+            # other requests keep using the current snapshot meanwhile
+            try:
+                self._reload(state)
+            finally:
+                state['reload'].release()
+        return state['snapshot']
+
+    def booked_actor_ids(self, movie, overlap_days):
+        '''ids of actors cast in a movie released close to this one'''
+        window = datetime.timedelta(days=overlap_days)
+        rows = db.session.query(Roles.actor_id).join(
+            Movies, Roles.movie_id == Movies.id).filter(
+            Movies.release_date.between(
+                movie.release_date - window,
+                movie.release_date + window),
+            Roles.actor_id.isnot(None)).distinct().all()
+        return np.array([r.actor_id for r in rows], dtype=np.int64)
+
+    def candidates(self, movie, min_age=None, max_age=None, gender=None,
+                   overlap_days=None, limit=10):
+        '''
+        Return (total_matches, candidates) for a movie.
+        Actors outside the age range, of another gender or already cast
+        in an overlapping movie are excluded; the rest are scored by how
+        close their age is to the middle of the requested range.
+        '''
+        if overlap_days is None:
+            overlap_days = current_app.config['CANDIDATE_OVERLAP_DAYS']
+        booked = self.booked_actor_ids(movie, overlap_days)
+        snapshot = self.snapshot()
+
+        with self._state()['lock']:
+            size = snapshot.size
+            ids = snapshot.ids[:size]
+            ages = snapshot.ages[:size]
+            mask = np.ones(size, dtype=bool)
+            if min_age is not None:
+                mask &= ages >= min_age
+            if max_age is not None:
+                mask &= ages <= max_age
+            if gender:
+                code = snapshot.gender_code(gender)
+                if code is None:
+                    return 0, []
+                mask &= snapshot.gender_codes[:size] == code
+            if len(booked):
+                mask &= ~np.isin(ids, booked)
+
+            # fancy indexing copies, the arrays may change once unlocked
+            rows = np.flatnonzero(mask)
+            ids = ids[rows]
+            ages = ages[rows].astype(np.float64)
+            names = snapshot.names[rows]
+            genders = snapshot.genders[rows]
+
+        if not len(rows):
+            return 0, []
+
+        if min_age is not None and max_age is not None:
+            middle = (min_age + max_age) / 2.0
+            spread = (max_age - min_age) / 2.0 + 1.0
+            scores = 1.0 - np.abs(ages - middle) / spread
+        elif min_age is not None or max_age is not None:
+            bound = min_age if min_age is not None else max_age
+            scores = 1.0 / (1.0 + np.abs(ages - bound))
+        else:
+            scores = np.ones(len(rows))
+
+        # partition finds the Kth best score in linear time, only the
+        # rows scoring at least that much are then fully ordered (best
+        # score first, lowest id on ties) so ties at the cut don't
+        # depend on the snapshot's row order
+        if limit < len(rows):
+            kth = np.partition(-scores, limit - 1)[limit - 1]
+            top = np.flatnonzero(-scores <= kth)
+        else:
+            top = np.arange(len(rows))
+        top = top[np.lexsort((ids[top], -scores[top]))][:limit]
+
+        results = []
+        for i in top:
+            results.append({
+                'id': int(ids[i]),
+                'name': names[i],
+                'age': int(ages[i]),
+                'gender': genders[i],
+                'score': round(float(scores[i]), 4)
+            })
+        return len(rows), results
+
+
+matcher = CastingMatcher()
@@ -1,3 +1,9 @@
+import sqlite3
+
+from sqlalchemy import DDL, event, insert, literal, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
 from sqlalchemy.sql.operators import nullslast_op
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
@@ -7,6 +13,49 @@ db = SQLAlchemy()
 migrate = Migrate()
 
 
+# SQLite only enforces foreign keys, and so ON DELETE CASCADE, when asked
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+class utcnow(FunctionElement):
+    '''
+    Current UTC time as the database sees it, so rows written by
+    different workers are not stamped by different clocks.
+    '''
+    type = db.DateTime()
+    name = 'utcnow'
+    inherit_cache = True
+
+
+@compiles(utcnow)
+def compile_utcnow(element, compiler, **kw):
+    return 'CURRENT_TIMESTAMP'
+
+
+@compiles(utcnow, 'postgresql')
+def compile_utcnow_postgresql(element, compiler, **kw):
+    # the time of the statement rather than of the transaction start
+    return "TIMEZONE('utc', STATEMENT_TIMESTAMP())"
+
+
+@compiles(utcnow, 'sqlite')
+def compile_utcnow_sqlite(element, compiler, **kw):
+    # milliseconds, padded to the microseconds SQLAlchemy reads back
+    return "STRFTIME('%Y-%m-%d %H:%M:%f000', 'now')"
+
+
+def record_tombstones(entity, model, *criteria):
+    '''insert a tombstone for every row matching criteria, in one statement'''
+    db.session.execute(insert(Tombstones).from_select(
+        ['entity', 'entity_id', 'deleted_at'],
+        select(literal(entity), model.id, utcnow()).where(*criteria)))
+
+
 #----------------------------------------------------------------------------#
 # Models.
 #----------------------------------------------------------------------------#
@@ -18,6 +67,16 @@ class Movies(db.Model):
     name = db.Column(db.String(500), nullable=False)
     release_date = db.Column(db.DateTime, nullable=False)
     genres = db.Column(db.String(500), nullable=False)
+    # stamped by the database, server_default also fills in rows that
+    # exist when the column is added
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=utcnow(), server_default=utcnow())
+    updated_at = db.Column(db.DateTime, nullable=False,
+                           default=utcnow(), onupdate=utcnow(),
+                           server_default=utcnow())
+
+    # the change feed scans by (updated_at, id)
+    __table_args__ = (db.Index('ix_movies_updated_at_id', 'updated_at', 'id'),)
 
     def insert(self):
         db.session.add(self)
@@ -27,8 +86,22 @@ class Movies(db.Model):
         db.session.commit()
 
     def delete(self):
-        db.session.delete(self)
+        Movies.delete_where(Movies.id == self.id)
+
+    @classmethod
+    def delete_where(cls, *criteria):
+        '''
+        Delete every movie matching criteria in one DELETE, their roles
+        are removed by the database through ON DELETE CASCADE.
+        Returns the number of movies deleted.
+        '''
+        matching = select(cls.id).where(*criteria)
+        record_tombstones('roles', Roles, Roles.movie_id.in_(matching))
+        record_tombstones('movies', cls, *criteria)
+        count = cls.query.filter(*criteria).delete(
+            synchronize_session='fetch')
         db.session.commit()
+        return count
 
     def format(self):
         return {
@@ -39,7 +112,10 @@ class Movies(db.Model):
         }
 
     # create many to many relationship one movie can have many roles
-    roles = db.relationship('Roles', backref='movies')
+    # the database deletes roles with their movie, see delete_where()
+    roles = db.relationship('Roles', backref='movies',
+                            cascade='all, delete-orphan',
+                            passive_deletes=True)
 
 
 class Actors(db.Model):
@@ -48,6 +124,15 @@ class Actors(db.Model):
     name = db.Column(db.String(500), nullable=False)
     age = db.Column(db.Integer(), nullable=False)
     gender = db.Column(db.String(120), nullable=False)
+    # stamped by the database, server_default also fills in rows that
+    # exist when the column is added
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=utcnow(), server_default=utcnow())
+    updated_at = db.Column(db.DateTime, nullable=False,
+                           default=utcnow(), onupdate=utcnow(),
+                           server_default=utcnow())
+
+    __table_args__ = (db.Index('ix_actors_updated_at_id', 'updated_at', 'id'),)
 
     def insert(self):
         db.session.add(self)
@@ -57,8 +142,22 @@ class Actors(db.Model):
         db.session.commit()
 
     def delete(self):
-        db.session.delete(self)
+        Actors.delete_where(Actors.id == self.id)
+
+    @classmethod
+    def delete_where(cls, *criteria):
+        '''
+        Delete every actor matching criteria in one DELETE, their roles
+        are removed by the database through ON DELETE CASCADE.
+        Returns the number of actors deleted.
+        '''
+        matching = select(cls.id).where(*criteria)
+        record_tombstones('roles', Roles, Roles.actor_id.in_(matching))
+        record_tombstones('actors', cls, *criteria)
+        count = cls.query.filter(*criteria).delete(
+            synchronize_session='fetch')
         db.session.commit()
+        return count
 
     def format(self):
         return {
@@ -72,17 +171,89 @@ class Actors(db.Model):
 class Roles(db.Model):
     __tablename__ = 'roles'
     id = db.Column(db.Integer, primary_key=True)
-    actor_id = db.Column(db.Integer, db.ForeignKey('actors.id'))
-    movie_id = db.Column(db.Integer, db.ForeignKey('movies.id'))
+    actor_id = db.Column(
+        db.Integer, db.ForeignKey('actors.id', ondelete='CASCADE'))
+    movie_id = db.Column(
+        db.Integer, db.ForeignKey('movies.id', ondelete='CASCADE'))
     role_name = db.Column(db.String(120), nullable=False)
+    # days the actor is booked for, both included
+    shoot_start = db.Column(db.Date)
+    shoot_end = db.Column(db.Date)
+    # stamped by the database, server_default also fills in rows that
+    # exist when the column is added
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=utcnow(), server_default=utcnow())
+    updated_at = db.Column(db.DateTime, nullable=False,
+                           default=utcnow(), onupdate=utcnow(),
+                           server_default=utcnow())
+
+    __table_args__ = (
+        db.Index('ix_roles_updated_at_id', 'updated_at', 'id'),
+        db.Index('ix_roles_actor_id_shoot_start', 'actor_id', 'shoot_start'),
+        db.CheckConstraint('shoot_start <= shoot_end',
+                           name='ck_roles_shoot_dates'))
 
     # create relationship between artist and show, one artist to many shows
-    actor = db.relationship('Actors', backref='roles')
+    actor = db.relationship('Actors', backref=db.backref(
+        'roles', cascade='all, delete-orphan', passive_deletes=True))
 
     def create(self):
         db.session.add(self)
         db.session.commit()
 
     def delete(self):
+        db.session.add(Tombstones(entity='roles', entity_id=self.id))
         db.session.delete(self)
         db.session.commit()
+
+    def format(self):
+        return {
+            'id': self.id,
+            'actor_id': self.actor_id,
+            'movie_id': self.movie_id,
+            'role_name': self.role_name,
+            'shoot_start': self.shoot_start,
+            'shoot_end': self.shoot_end
+        }
+
+
+# On Postgres an actor can't be booked twice on the same day. The GiST
+# index behind the constraint also serves the conflict queries in
+# schedule.py. Migrations don't generate it, `flask schedule-constraint`
+# adds it to a migrated database.
+ROLES_SCHEDULE_EXCLUSION = DDL(
+    'CREATE EXTENSION IF NOT EXISTS btree_gist; '
+    'ALTER TABLE roles ADD CONSTRAINT roles_actor_schedule_excl '
+    'EXCLUDE USING gist ('
+    'actor_id WITH =, '
+    "daterange(shoot_start, shoot_end, '[]') WITH &&) "
+    'WHERE (shoot_start IS NOT NULL AND shoot_end IS NOT NULL)')
+event.listen(Roles.__table__, 'after_create',
+             ROLES_SCHEDULE_EXCLUSION.execute_if(dialect='postgresql'))
+
+
+class Tombstones(db.Model):
+    '''
+    Records deleted rows so clients syncing through the change feed
+    learn about deletes as well as inserts and updates.
+    '''
+    __tablename__ = 'tombstones'
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False,
+                           default=utcnow(), server_default=utcnow())
+
+    __table_args__ = (
+        db.Index('ix_tombstones_deleted_at_id', 'deleted_at', 'id'),)
+
+
+class AuditLog(db.Model):
+    '''Who (the token subject) created, updated or deleted which row.'''
+    __tablename__ = 'audit_log'
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(200))
+    action = db.Column(db.String(20), nullable=False)
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    occurred_at = db.Column(db.DateTime, nullable=False, index=True)
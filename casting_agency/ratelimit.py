@@ -0,0 +1,209 @@
+import math
+import threading
+import time
+
+from flask import current_app, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+#----------------------------------------------------------------------------#
+# Rate limiting and load shedding.
+#----------------------------------------------------------------------------#
+
+'''
+Every authorized request takes a token from a bucket keyed by the JWT
+subject and the permission it used, so each permission has its own
+budget per caller. Budgets are (tokens per second, burst) pairs.
+Separately the time sessions spend waiting for a database connection
+is tracked, while it is above SHED_WAIT_THRESHOLD new requests are
+turned away with 503 instead of queueing up on the pool. Only requests
+that actually check out a connection are timed, reads served from
+memory never touch the pool.
+'''
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        self.status_code = 429
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        self.status_code = 503
+
+
+class MemoryStore:
+    '''Token buckets held by this worker.'''
+    # buckets that have refilled completely, at their own rate, are
+    # dropped once this many keys are tracked
+    max_keys = 10000
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        '''Take one token, return 0 or the seconds until one is available.'''
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (burst, now))[:2]
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now, rate, burst)
+                if len(self.buckets) > self.max_keys:
+                    self._prune(now)
+                return 0
+            self.buckets[key] = (tokens, now, rate, burst)
+            return (1 - tokens) / rate
+
+    def _prune(self, now):
+        self.buckets = {
+            key: bucket for key, bucket in self.buckets.items()
+            if bucket[0] + (now - bucket[1]) * bucket[2] < bucket[3]
+        }
+
+
+class RedisStore:
+    '''Token buckets shared by every worker through Redis.'''
+    script = '''
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local tokens = tonumber(bucket[1]) or burst
+        local updated = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + (now - updated) * rate)
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return tostring(wait)
+    '''
+
+    def __init__(self, url):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.take_script = self.client.register_script(self.script)
+
+    def take(self, key, rate, burst):
+        return float(self.take_script(
+            keys=['ratelimit:' + key], args=[rate, burst, time.time()]))
+
+
+class LoadShedder:
+    '''
+    Keeps a moving average of connection pool wait time. Once it goes
+    over the threshold every new request is rejected for retry_after
+    seconds, then requests are let through again to take new samples.
+    The request that took the sample already holds its connection and
+    is left to finish.
+    '''
+    weight = 0.2
+
+    def __init__(self, threshold, retry_after):
+        self.threshold = threshold
+        self.retry_after = retry_after
+        self.average = 0.0
+        self.shed_until = 0.0
+
+    def check(self):
+        remaining = self.shed_until - time.monotonic()
+        if remaining > 0:
+            raise Overloaded(remaining)
+
+    def observe(self, wait):
+        self.average += self.weight * (wait - self.average)
+        if self.average > self.threshold:
+            self.shed_until = time.monotonic() + self.retry_after
+            # a single fast sample after the pause is enough to recover
+            self.average = self.threshold
+
+
+class RateLimiter:
+
+    def init_app(self, app):
+        app.config.setdefault('RATELIMIT_ENABLED', True)
+        app.config.setdefault('RATELIMIT_STORAGE_URL', None)
+        app.config.setdefault('RATELIMIT_DEFAULT', (5, 10))
+        app.config.setdefault('RATELIMIT_BUDGETS', {
+            'get:movies': (20, 40),
+            'get:actors': (20, 40),
+            'post:movies': (1, 10),
+            'patch:movies': (1, 10),
+            'delete:movies': (1, 10),
+            'post:actors': (1, 10),
+            'patch:actors': (1, 10),
+            'delete:actors': (1, 10)
+        })
+        app.config.setdefault('SHED_WAIT_THRESHOLD', 0.5)
+        app.config.setdefault('SHED_RETRY_AFTER', 5)
+
+        url = app.config['RATELIMIT_STORAGE_URL']
+        app.extensions['rate_limiter'] = {
+            'store': RedisStore(url) if url else MemoryStore(),
+            'shedder': LoadShedder(app.config['SHED_WAIT_THRESHOLD'],
+                                   app.config['SHED_RETRY_AFTER'])
+        }
+
+    def check(self, permission, payload):
+        '''
+        Called by requires_auth once the permission is verified.
+        Raises RateLimitExceeded or Overloaded to reject the request.
+        '''
+        state = current_app.extensions.get('rate_limiter')
+        if state is None or not current_app.config['RATELIMIT_ENABLED']:
+            return
+
+        rate, burst = current_app.config['RATELIMIT_BUDGETS'].get(
+            permission, current_app.config['RATELIMIT_DEFAULT'])
+        subject = payload.get('sub') or request.remote_addr
+        wait = state['store'].take(
+            '{}:{}'.format(subject, permission), rate, burst)
+        if wait:
+            raise RateLimitExceeded(wait)
+
+        state['shedder'].check()
+
+
+# A session checks out its connection on the first statement or flush
+# of a transaction, after_begin fires once it has one.
+@event.listens_for(Session, 'do_orm_execute')
+def start_checkout_timer(orm_execute_state):
+    orm_execute_state.session.info.setdefault(
+        'checkout_started', time.monotonic())
+
+
+@event.listens_for(Session, 'before_flush')
+def start_flush_checkout_timer(session, flush_context, instances):
+    session.info.setdefault('checkout_started', time.monotonic())
+
+
+@event.listens_for(Session, 'after_begin')
+def observe_checkout(session, transaction, connection):
+    started = session.info.pop('checkout_started', None)
+    if started is None or not has_app_context():
+        return
+    state = current_app.extensions.get('rate_limiter')
+    if state is not None:
+        state['shedder'].observe(time.monotonic() - started)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def clear_checkout_timer(session, transaction):
+    # statements of a transaction that already had its connection
+    session.info.pop('checkout_started', None)
+
+
+def retry_after_header(seconds):
+    return str(max(1, math.ceil(seconds)))
+
+
+limiter = RateLimiter()
@@ -0,0 +1,174 @@
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from contextlib import contextmanager
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import func, text
+
+from .models import db, Roles, ROLES_SCHEDULE_EXCLUSION
+
+
+#----------------------------------------------------------------------------#
+# Actor scheduling.
+#----------------------------------------------------------------------------#
+
+'''
+A role books its actor from shoot_start to shoot_end, both days
+included. On Postgres overlapping bookings are found with the
+daterange && operator, served by the GiST index of the exclusion
+constraint on roles, which also rejects double bookings that race past
+the check, across workers and the importer. The constraint is created
+with the tables, or added to an existing database by
+`flask schedule-constraint` after the migrations. Other databases use an IntervalIndex per actor kept in
+memory. There a booking checks and creates the role while holding the
+actor's lock, against an index read from the database at that moment,
+so roles written by other workers or the importer are seen. Cached
+indexes serve availability reads for SCHEDULE_INDEX_TTL seconds.
+'''
+
+
+class IntervalIndex:
+    '''
+    One actor's bookings sorted by start, with the running maximum of
+    end dates. Bookings that can overlap a period all start before it
+    ends, and walking those back from the latest stops as soon as no
+    earlier booking can reach the start of the period.
+    '''
+
+    def __init__(self, bookings=()):
+        # (start, end, role id) tuples
+        self.bookings = sorted(bookings)
+        self._rebuild(0)
+
+    def _rebuild(self, position):
+        self.starts = [booking[0] for booking in self.bookings]
+        self.max_ends = self.max_ends[:position] if position else []
+        for booking in self.bookings[position:]:
+            end = booking[1]
+            if self.max_ends and self.max_ends[-1] > end:
+                end = self.max_ends[-1]
+            self.max_ends.append(end)
+
+    def add(self, start, end, id):
+        position = bisect_left(self.bookings, (start, end, id))
+        if self.bookings[position:position + 1] == [(start, end, id)]:
+            return
+        insort(self.bookings, (start, end, id))
+        self._rebuild(bisect_left(self.starts, start))
+
+    def overlapping(self, start, end):
+        '''ids of the bookings that share at least one day with the period'''
+        ids = []
+        position = bisect_right(self.starts, end) - 1
+        while position >= 0 and self.max_ends[position] >= start:
+            if self.bookings[position][1] >= start:
+                ids.append(self.bookings[position][2])
+            position -= 1
+        return ids[::-1]
+
+
+class Schedule:
+
+    def init_app(self, app):
+        app.config.setdefault('SCHEDULE_INDEX_TTL', 60)
+        app.extensions['schedule'] = {
+            # actor id -> (built_at, IntervalIndex)
+            'actors': {},
+            # held while booking an actor, actors share them by id
+            'bookings': [threading.Lock() for _ in range(64)],
+            'lock': threading.Lock()
+        }
+
+    def _state(self):
+        return current_app.extensions['schedule']
+
+    def invalidate(self):
+        '''forget the in-memory indexes after roles were changed'''
+        state = self._state()
+        with state['lock']:
+            state['actors'] = {}
+
+    def _index(self, actor_id, fresh=False):
+        state = self._state()
+        ttl = current_app.config['SCHEDULE_INDEX_TTL']
+        with state['lock']:
+            cached = state['actors'].get(actor_id)
+        if cached is not None and not fresh and \
+                time.monotonic() - cached[0] < ttl:
+            return cached[1]
+
+        rows = db.session.query(
+            Roles.shoot_start, Roles.shoot_end, Roles.id).filter(
+            Roles.actor_id == actor_id,
+            Roles.shoot_start.isnot(None),
+            Roles.shoot_end.isnot(None)).all()
+        index = IntervalIndex(tuple(row) for row in rows)
+        with state['lock']:
+            state['actors'][actor_id] = (time.monotonic(), index)
+        return index
+
+    @contextmanager
+    def booking(self, actor_id):
+        '''
+        Hold while checking conflicts for and creating a role of the
+        actor, concurrent bookings of the same actor in this worker wait.
+        '''
+        bookings = self._state()['bookings']
+        with bookings[actor_id % len(bookings)]:
+            yield
+
+    def conflicts(self, actor_id, start, end, fresh=False):
+        '''
+        roles of the actor shooting on any day from start to end, fresh
+        reads the roles from the database instead of a cached index
+        '''
+        if db.engine.dialect.name == 'postgresql':
+            # undated roles book nothing, the partial GiST index only
+            # covers dated ones
+            return Roles.query.filter(
+                Roles.actor_id == actor_id,
+                Roles.shoot_start.isnot(None),
+                Roles.shoot_end.isnot(None),
+                func.daterange(Roles.shoot_start, Roles.shoot_end, '[]').op(
+                    '&&')(func.daterange(start, end, '[]'))
+            ).order_by(Roles.shoot_start).all()
+
+        index = self._index(actor_id, fresh)
+        with self._state()['lock']:
+            ids = index.overlapping(start, end)
+        if not ids:
+            return []
+        roles = {role.id: role
+                 for role in Roles.query.filter(Roles.id.in_(ids))}
+        return [roles[id] for id in ids if id in roles]
+
+    def booked(self, role):
+        '''add a newly created role to the in-memory index'''
+        state = self._state()
+        with state['lock']:
+            cached = state['actors'].get(role.actor_id)
+            if cached is not None and role.shoot_start and role.shoot_end:
+                cached[1].add(role.shoot_start, role.shoot_end, role.id)
+
+
+schedule = Schedule()
+
+
+@click.command('schedule-constraint')
+@with_appcontext
+def schedule_constraint_command():
+    '''Add the constraint rejecting double bookings on Postgres.'''
+    if db.engine.dialect.name != 'postgresql':
+        click.echo('Only Postgres supports the constraint, nothing to do.')
+        return
+    if db.session.execute(text(
+            "SELECT 1 FROM pg_constraint "
+            "WHERE conname = 'roles_actor_schedule_excl'")).first():
+        click.echo('The constraint already exists.')
+        return
+    db.session.execute(text(ROLES_SCHEDULE_EXCLUSION.statement))
+    db.session.commit()
+    click.echo('Added the roles_actor_schedule_excl constraint.')
@@ -2,4 +2,5 @@
 export FLASK_APP=casting_agency.app
 flask db init
 flask db migrate -m "Initial migration"
-flask db upgrade
\ No newline at end of file
+flask db upgrade
+flask schedule-constraint
\ No newline at end of file
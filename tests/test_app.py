@@ -1,21 +1,39 @@
 import os
+import time
+import tempfile
 import datetime
+import threading
 import unittest
 import json
+import random
+import sqlite3
 import urllib.parse
 import urllib.request
-from unittest.mock import patch
+from unittest.mock import MagicMock, Mock, patch
 
 from flask_sqlalchemy import SQLAlchemy
 from flask import Flask
+from sqlalchemy.exc import IntegrityError
 
 from casting_agency.app import create_app
-from casting_agency.models import db, migrate, Movies, Actors
+from casting_agency.models import (db, migrate, Movies, Actors, Roles,
+                                   AuditLog)
+from casting_agency import importer
+from casting_agency.audit import audit
+from casting_agency.schedule import IntervalIndex, schedule
+from casting_agency.coalesce import single_flight
+from casting_agency.matching import ActorSnapshot, matcher
+from casting_agency.catalog import ActorRow, TableSnapshot, catalog
+from casting_agency.ratelimit import MemoryStore
+from casting_agency.events import PostgresBackend
 
 TEST_CONFIG = {
     'TESTING': True,
     'SQLALCHEMY_DATABASE_URI': 'sqlite://',
-    'SQLALCHEMY_TRACK_MODIFICATIONS': False
+    'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+    'CHANGES_SETTLE_SECONDS': 0,
+    # the audit thread would share the in-memory database with the tests
+    'AUDIT_ENABLED': False
 }
 
 TEST_HEADERS = {
@@ -50,7 +68,8 @@ PRODUCER_PAYLOAD = {
         'get:actors',
         'post:actors',
         'patch:actors',
-        'delete:actors'
+        'delete:actors',
+        'get:metrics'
     ]
 }
 
@@ -59,6 +78,14 @@ NOPERM_PAYLOAD = {
 }
 
 
+def settle():
+    '''
+    SQLite stamps changes to the millisecond, the change feed only returns
+    those older than the current millisecond
+    '''
+    time.sleep(0.002)
+
+
 class CastingAgencyTestCase(unittest.TestCase):
     """This class represents the casting agency test case"""
 
@@ -105,6 +132,7 @@ class CastingAgencyTestCase(unittest.TestCase):
             db.session.add(test_movie)
             db.session.add(test_actor)
             db.session.commit()
+        settle()
 
     def tearDown(self):
         """Executed after reach test"""
@@ -300,6 +328,920 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 401)
         self.assertEqual(data['success'], False)
 
+    '''test ranking candidates for a movie'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=ASSISTANT_PAYLOAD)
+    def test_get_candidates(self, mock):
+        with self.app.app_context():
+            db.session.add(Actors(name='Cast', age=21, gender='Female'))
+            db.session.add(Actors(name='Older', age=60, gender='Female'))
+            db.session.add(Actors(name='Other', age=20, gender='Male'))
+            db.session.add(Roles(actor_id=2, movie_id=1, role_name='Lead'))
+            db.session.commit()
+
+        res = self.client.get(
+            '/movies/1/candidates?min_age=18&max_age=30&gender=female',
+            headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_matches'], 1)
+        self.assertEqual(data['candidates'][0]['name'], 'Testing')
+
+    '''test actor writes are applied to the candidate snapshot in place'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=PRODUCER_PAYLOAD)
+    def test_candidates_snapshot_follows_writes(self, mock):
+        self.client.get('/movies/1/candidates', headers=TEST_HEADERS)
+        snapshot = self.app.extensions['casting_matcher']['snapshot']
+
+        self.client.post('/actors', json=self.test_actor, headers=TEST_HEADERS)
+        self.client.patch(
+            '/actors/2', json={'gender': 'Female'}, headers=TEST_HEADERS)
+        self.client.delete('/actors/1', headers=TEST_HEADERS)
+
+        res = self.client.get(
+            '/movies/1/candidates?gender=female', headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertIs(
+            self.app.extensions['casting_matcher']['snapshot'], snapshot)
+        self.assertEqual(
+            [(actor['id'], actor['age']) for actor in data['candidates']],
+            [(2, 40)])
+
+    '''test writes applied during a snapshot reload are kept'''
+    def test_candidates_snapshot_reload_keeps_writes(self):
+        load = matcher._load
+
+        def racing_load():
+            snapshot = load()
+            # committed after the read, applied before the swap
+            matcher.apply('created', 99, {'id': 99, 'name': 'Late',
+                                          'age': 30, 'gender': 'Male'})
+            return snapshot
+
+        with self.app.app_context():
+            matcher.snapshot()
+            self.app.config['CANDIDATE_SNAPSHOT_TTL'] = 0
+            with patch.object(matcher, '_load', racing_load):
+                snapshot = matcher.snapshot()
+
+        self.assertIn(99, snapshot.rows)
+        self.assertIsNone(
+            self.app.extensions['casting_matcher']['pending'])
+
+    '''test candidates tied on score are cut by lowest id'''
+    def test_candidates_ties_by_id(self):
+        ids = list(range(1, 201))
+        random.Random(1).shuffle(ids)
+        snapshot = ActorSnapshot([])
+        for id in ids:
+            snapshot.put({'id': id, 'name': 'Actor', 'age': 20 + id % 2,
+                          'gender': 'Female'})
+        movie = Movies(release_date=datetime.date.today())
+
+        with self.app.app_context():
+            self.app.extensions['casting_matcher']['snapshot'] = snapshot
+            total, candidates = matcher.candidates(
+                movie, min_age=18, max_age=22, limit=5)
+
+        self.assertEqual(total, 200)
+        self.assertEqual([actor['id'] for actor in candidates],
+                         [2, 4, 6, 8, 10])
+
+    '''test a failing cache update doesn't fail a committed write'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=PRODUCER_PAYLOAD)
+    def test_patch_actor_with_failing_side_effect(self, mock):
+        self.client.get('/movies/1/candidates', headers=TEST_HEADERS)
+        snapshot = self.app.extensions['casting_matcher']['snapshot']
+
+        # SQLite stores the text, the candidate snapshot can't
+        res = self.client.patch(
+            '/actors/1', json={'age': 'abc'}, headers=TEST_HEADERS)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(snapshot.ages[snapshot.rows[1]], 19)
+
+        with patch('casting_agency.app.audit.record',
+                   side_effect=RuntimeError('audit down')):
+            res = self.client.patch(
+                '/actors/1', json={'age': 20}, headers=TEST_HEADERS)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(snapshot.ages[snapshot.rows[1]], 20)
+
+    '''test ranking candidates failed due to invalid age range or overlap'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=ASSISTANT_PAYLOAD)
+    def test_400_candidates_invalid_age_range(self, mock):
+        res = self.client.get(
+            '/movies/1/candidates?min_age=40&max_age=20',
+            headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+        for overlap_days in ('99999999', '-1'):
+            res = self.client.get(
+                '/movies/1/candidates?overlap_days=' + overlap_days,
+                headers=TEST_HEADERS)
+            self.assertEqual(res.status_code, 400)
+
+    '''test ranking candidates failed movie not found'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=ASSISTANT_PAYLOAD)
+    def test_404_candidates_movie_not_found(self, mock):
+        res = self.client.get('/movies/1000/candidates', headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    '''test change feed returns updates and deletes after a cursor'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=PRODUCER_PAYLOAD)
+    def test_get_changes(self, mock):
+        res = self.client.get('/changes?since=0', headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['changes']), 2)
+        self.assertEqual(data['has_more'], False)
+
+        self.client.patch(
+            '/movies/1', json=self.edited_movie, headers=TEST_HEADERS)
+        self.client.delete('/actors/1', headers=TEST_HEADERS)
+        settle()
+
+        res = self.client.get(
+            '/changes?since=' + data['cursor'], headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            [(c['type'], c['op'], c['id']) for c in data['changes']],
+            [('movies', 'upsert', 1), ('actors', 'delete', 1)])
+
+    '''test change feed paginates without skipping rows'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=PRODUCER_PAYLOAD)
+    def test_get_changes_paginated(self, mock):
+        res = self.client.get('/changes?limit=1', headers=TEST_HEADERS)
+        first = json.loads(res.data)
+
+        self.assertEqual(len(first['changes']), 1)
+        self.assertEqual(first['has_more'], True)
+
+        res = self.client.get(
+            '/changes?limit=1&since=' + first['cursor'], headers=TEST_HEADERS)
+        second = json.loads(res.data)
+
+        self.assertEqual(len(second['changes']), 1)
+        self.assertEqual(second['has_more'], False)
+        self.assertEqual(
+            {first['changes'][0]['type'], second['changes'][0]['type']},
+            {'movies', 'actors'})
+
+    '''test change feed hides actors without permission'''
+    @patch('casting_agency.auth.verify_decode_jwt',
+           return_value={'permissions': ['get:movies']})
+    def test_get_changes_filtered_by_permission(self, mock):
+        res = self.client.get('/changes', headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([c['type'] for c in data['changes']], ['movies'])
+
+    '''test change feed holds back changes younger than the settle time'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=PRODUCER_PAYLOAD)
+    def test_get_changes_waits_to_settle(self, mock):
+        self.app.config['CHANGES_SETTLE_SECONDS'] = 60
+        res = self.client.get('/changes', headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['changes'], [])
+        self.assertEqual(data['cursor'], '0')
+
+    '''test change feed failed due to malformed cursor'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=ASSISTANT_PAYLOAD)
+    def test_400_changes_invalid_cursor(self, mock):
+        res = self.client.get('/changes?since=abc', headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+        res = self.client.get(
+            '/changes?since=99999999999999999999-0-1', headers=TEST_HEADERS)
+        self.assertEqual(res.status_code, 400)
+
+    '''test event stream pushes catalog changes'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=PRODUCER_PAYLOAD)
+    def test_events_stream(self, mock):
+        res = self.client.get(
+            '/events', headers=TEST_HEADERS, buffered=False)
+        stream = iter(res.response)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        self.assertEqual(next(stream), b': connected\n\n')
+
+        self.client.post('/movies', json=self.test_movie, headers=TEST_HEADERS)
+        event = next(stream).decode()
+
+        self.assertTrue(event.startswith('event: created\n'))
+        self.assertEqual(json.loads(event.split('data: ')[1])['type'], 'movies')
+        res.close()
+
+    '''test event stream drops a client whose queue overflows'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=PRODUCER_PAYLOAD)
+    def test_events_stream_overflow(self, mock):
+        self.app.config['EVENTS_QUEUE_SIZE'] = 1
+        res = self.client.get(
+            '/events', headers=TEST_HEADERS, buffered=False)
+        stream = iter(res.response)
+        next(stream)
+
+        self.client.patch('/actors/1', json=self.edited_actor,
+                          headers=TEST_HEADERS)
+        self.client.patch('/actors/1', json=self.edited_actor,
+                          headers=TEST_HEADERS)
+
+        self.assertEqual(next(stream), b'event: overflow\ndata: {}\n\n')
+        self.assertRaises(StopIteration, next, stream)
+
+    '''test event streams are capped below the worker's thread count'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=PRODUCER_PAYLOAD)
+    def test_503_events_stream_full(self, mock):
+        app = create_app(dict(TEST_CONFIG, WEB_THREADS=8))
+        self.assertEqual(app.config['EVENTS_MAX_SUBSCRIBERS'], 2)
+
+        self.app.config['EVENTS_MAX_SUBSCRIBERS'] = 1
+        res = self.client.get(
+            '/events', headers=TEST_HEADERS, buffered=False)
+        next(iter(res.response))
+
+        full = self.client.get('/events', headers=TEST_HEADERS)
+        self.assertEqual(full.status_code, 503)
+        res.close()
+
+    '''test full buckets are pruned at their own rate'''
+    def test_rate_limit_prune_per_bucket(self):
+        store = MemoryStore()
+        store.max_keys = 1
+        store.take('slow', 0.001, 1)
+        store.take('fast', 1000, 2)
+        time.sleep(0.01)
+        store.take('other', 1000, 2)
+
+        self.assertIn('slow', store.buckets)
+        self.assertNotIn('fast', store.buckets)
+
+    '''test Postgres notifications stay under the payload limit in bytes'''
+    def test_postgres_events_payload_limit(self):
+        backend = PostgresBackend()
+        backend.engine = MagicMock()
+        conn = backend.engine.begin.return_value.__enter__.return_value
+        message = json.dumps({'type': 'movies', 'op': 'updated', 'id': 1,
+                              'data': {'name': '\u00e9' * 5000}},
+                             ensure_ascii=False)
+        self.assertLess(len(message), backend.max_payload)
+
+        backend.publish('movies', 'updated', message)
+
+        sent = conn.execute.call_args[1]['message']
+        self.assertEqual(json.loads(sent),
+                         {'type': 'movies', 'op': 'updated', 'id': 1})
+
+    '''test the Postgres listener closes its connection before reconnecting'''
+    def test_postgres_events_listener_closes_connection(self):
+        class Stop(BaseException):
+            pass
+
+        backend = PostgresBackend()
+        backend.engine = Mock()
+        conn = backend.engine.raw_connection.return_value
+        conn.set_session.side_effect = RuntimeError('connection lost')
+
+        with patch('casting_agency.events.time.sleep', side_effect=Stop):
+            self.assertRaises(Stop, backend._listen)
+
+        conn.close.assert_called_once_with()
+
+    '''test write requests are rate limited per subject'''
+    @patch('casting_agency.auth.verify_decode_jwt',
+           return_value=dict(PRODUCER_PAYLOAD, sub='auth0|producer'))
+    def test_429_rate_limited(self, mock):
+        self.app.config['RATELIMIT_BUDGETS'] = {'post:actors': (0.01, 1)}
+        res = self.client.post(
+            '/actors', json=self.test_actor, headers=TEST_HEADERS)
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client.post(
+            '/actors', json=self.test_actor, headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(res.headers['Retry-After'], '100')
+
+        # other permissions have their own budget
+        res = self.client.get('/actors', headers=TEST_HEADERS)
+        self.assertEqual(res.status_code, 200)
+
+    '''test requests are shed while the connection pool is saturated'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=ASSISTANT_PAYLOAD)
+    def test_503_load_shedding(self, mock):
+        shedder = self.app.extensions['rate_limiter']['shedder']
+        shedder.threshold = -1
+        # the request that waited for its connection still completes
+        res = self.client.get('/movies', headers=TEST_HEADERS)
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client.get('/movies', headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(res.headers['Retry-After'], '5')
+
+        shedder.threshold = 0.5
+        res = self.client.get('/movies', headers=TEST_HEADERS)
+        self.assertEqual(res.status_code, 503)
+
+    '''test reads served from memory don't check out a connection'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=ASSISTANT_PAYLOAD)
+    def test_load_shedding_skips_reads_from_memory(self, mock):
+        self.app.config['CATALOG_READ_MODEL'] = True
+        self.client.get('/movies', headers=TEST_HEADERS)
+
+        shedder = self.app.extensions['rate_limiter']['shedder']
+        shedder.threshold = -1
+        res = self.client.get('/movies', headers=TEST_HEADERS)
+        self.assertEqual(res.status_code, 200)
+        res = self.client.get('/movies', headers=TEST_HEADERS)
+        self.assertEqual(res.status_code, 200)
+        shedder.threshold = 0.5
+
+    '''test getting a movie by id'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=ASSISTANT_PAYLOAD)
+    def test_get_movie(self, mock):
+        res = self.client.get('/movies/1', headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['movie']['name'], 'Testing')
+
+        mock.return_value = PRODUCER_PAYLOAD
+        res = self.client.get('/metrics', headers=TEST_HEADERS)
+        data = json.loads(res.data)
+        self.assertEqual(data['coalescing'], {'executed': 1, 'coalesced': 0})
+
+    '''test metrics need a token with the metrics permission'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=ASSISTANT_PAYLOAD)
+    def test_metrics_requires_permission(self, mock):
+        res = self.client.get('/metrics')
+        self.assertEqual(res.status_code, 401)
+
+        res = self.client.get('/metrics', headers=TEST_HEADERS)
+        self.assertEqual(res.status_code, 403)
+
+    '''test concurrent identical reads share a single call'''
+    def test_single_flight_coalesces_concurrent_calls(self):
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def load():
+            calls.append(1)
+            release.wait(5)
+            return 'body'
+
+        def read():
+            with self.app.app_context():
+                results.append(single_flight.do(('movie', '1'), load))
+
+        threads = [threading.Thread(target=read) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        with self.app.app_context():
+            for _ in range(500):
+                if single_flight.stats()['coalesced'] == 4:
+                    break
+                time.sleep(0.01)
+            release.set()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(results, ['body'] * 5)
+            self.assertEqual(
+                single_flight.stats(), {'executed': 1, 'coalesced': 4})
+
+    '''test getting many actors by id in one request'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=ASSISTANT_PAYLOAD)
+    def test_get_actors_by_ids(self, mock):
+        with self.app.app_context():
+            db.session.add(Actors(name='Second', age=30, gender='Male'))
+            db.session.commit()
+
+        res = self.client.get('/actors?ids=2,1000,1', headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([actor['id'] for actor in data['actors']], [2, 1])
+        self.assertEqual(data['missing'], [1000])
+
+    '''test getting many movies by id with a request body'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=ASSISTANT_PAYLOAD)
+    def test_get_movies_batch(self, mock):
+        res = self.client.post(
+            '/movies/batch', json={'ids': [1, 2]}, headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['id'] for movie in data['movies']], [1])
+        self.assertEqual(data['missing'], [2])
+
+    '''test getting many movies failed due to invalid or too many ids'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=ASSISTANT_PAYLOAD)
+    def test_400_get_movies_invalid_ids(self, mock):
+        res = self.client.get('/movies?ids=1,abc', headers=TEST_HEADERS)
+        self.assertEqual(res.status_code, 400)
+
+        self.app.config['MAX_BATCH_SIZE'] = 2
+        res = self.client.post(
+            '/movies/batch', json={'ids': [1, 2, 3]}, headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+        for body in ([1, 2], 'ids', 1):
+            res = self.client.post(
+                '/movies/batch', json=body, headers=TEST_HEADERS)
+            self.assertEqual(res.status_code, 400)
+            res = self.client.post(
+                '/actors/batch', json=body, headers=TEST_HEADERS)
+            self.assertEqual(res.status_code, 400)
+
+    '''test filtering and paginating movies'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=ASSISTANT_PAYLOAD)
+    def test_get_movies_filtered_and_paginated(self, mock):
+        with self.app.app_context():
+            for name in ('Second', 'Third'):
+                db.session.add(Movies(
+                    name=name,
+                    release_date=datetime.date.today(),
+                    genres='Drama'))
+            db.session.commit()
+
+        res = self.client.get(
+            '/movies?genres=Drama&page=2&per_page=1', headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_movies'], 2)
+        self.assertEqual([movie['name'] for movie in data['movies']],
+                         ['Third'])
+
+    '''test list reads served from the in-memory read model'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=PRODUCER_PAYLOAD)
+    def test_get_movies_from_read_model(self, mock):
+        from_db = self.client.get(
+            '/movies?page=1', headers=TEST_HEADERS).data
+        self.app.config['CATALOG_READ_MODEL'] = True
+        self.assertEqual(
+            self.client.get('/movies?page=1', headers=TEST_HEADERS).data,
+            from_db)
+
+        # writes of this worker are applied straight away
+        self.client.post('/movies', json=self.test_movie, headers=TEST_HEADERS)
+        self.client.delete('/movies/1', headers=TEST_HEADERS)
+        data = json.loads(
+            self.client.get('/movies', headers=TEST_HEADERS).data)
+        self.assertEqual([movie['id'] for movie in data['movies']], [2])
+
+        # writes of other workers are picked up from the change feed
+        self.app.config['CATALOG_MAX_STALENESS'] = 0
+        with self.app.app_context():
+            db.session.add(Movies(
+                name='Elsewhere',
+                release_date=datetime.date.today(),
+                genres='Drama'))
+            db.session.commit()
+        settle()
+        data = json.loads(
+            self.client.get('/movies?genres=Drama', headers=TEST_HEADERS).data)
+        self.assertEqual([movie['name'] for movie in data['movies']],
+                         ['This is a new test movie', 'Elsewhere'])
+
+    '''test filtered pages of the read model follow updates and deletes'''
+    def test_read_model_filter_index(self):
+        table = TableSnapshot(ActorRow)
+        for id, gender in ((3, 'Male'), (1, 'Female'), (2, 'Male')):
+            table.put({'id': id, 'name': 'Actor', 'age': 30,
+                       'gender': gender})
+        table.put({'id': 2, 'name': 'Actor', 'age': 30, 'gender': 'Female'})
+        table.remove(1)
+
+        total, rows = table.select({'gender': 'Female'}, 1, 10)
+        self.assertEqual(total, 1)
+        self.assertEqual(json.loads(rows[0])['id'], 2)
+        self.assertEqual(table.select({'gender': 'Male'}, 1, 1)[0], 1)
+        self.assertEqual(table.select({'gender': 'Other'}, None, 10), (0, []))
+
+    '''test writes applied while the read model loads are kept'''
+    def test_read_model_load_keeps_writes(self):
+        self.app.config['CATALOG_READ_MODEL'] = True
+        load = catalog._load
+
+        def racing_load():
+            tables, cursor = load()
+            # committed after the read, applied before the swap
+            catalog.apply('movies', 'created', 99, {
+                'id': 99, 'name': 'Late', 'genres': 'Drama',
+                'release_date': '2021-06-01'})
+            return tables, cursor
+
+        with self.app.test_request_context(), \
+                patch.object(catalog, '_load', racing_load):
+            body = json.loads(catalog.serve('movies', {}, None, 20))
+
+        self.assertEqual([movie['id'] for movie in body['movies']], [1, 99])
+        self.assertIsNone(
+            self.app.extensions['catalog_read_model']['pending'])
+
+    '''test deleting a movie deletes its roles in the database'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=PRODUCER_PAYLOAD)
+    def test_delete_movie_cascades_to_roles(self, mock):
+        with self.app.app_context():
+            db.session.add(Roles(actor_id=1, movie_id=1, role_name='Lead'))
+            db.session.add(Roles(actor_id=1, movie_id=1, role_name='Double'))
+            db.session.commit()
+
+        res = self.client.delete('/movies/1', headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], 1)
+        with self.app.app_context():
+            self.assertEqual(Roles.query.count(), 0)
+            self.assertEqual(Actors.query.count(), 1)
+
+        res = self.client.get('/changes', headers=TEST_HEADERS)
+        deleted = [(c['type'], c['id']) for c in json.loads(res.data)['changes']
+                   if c['op'] == 'delete']
+        self.assertEqual(sorted(deleted),
+                         [('movies', 1), ('roles', 1), ('roles', 2)])
+
+    '''test deleting movies by predicate'''
+    def test_delete_movies_where(self):
+        with self.app.app_context():
+            db.session.add(Movies(
+                name='Old',
+                release_date=datetime.date(1990, 1, 1),
+                genres='Drama'))
+            db.session.commit()
+
+            count = Movies.delete_where(
+                Movies.release_date < datetime.date(2000, 1, 1))
+
+            self.assertEqual(count, 1)
+            self.assertEqual(
+                [movie.name for movie in Movies.query.all()], ['Testing'])
+
+    def write_file(self, suffix, text):
+        file = tempfile.NamedTemporaryFile(
+            'w', suffix=suffix, delete=False, encoding='utf-8')
+        file.write(text)
+        file.close()
+        self.addCleanup(os.remove, file.name)
+        return file.name
+
+    '''test importing movies from a csv file'''
+    def test_import_movies_csv(self):
+        path = self.write_file('.csv', (
+            'name,release_date,genres\n'
+            'Up!,2009-05-29,Animation\n'
+            'No date,,Drama\n'
+            'Coco,2017-11-22,Animation\n'))
+
+        result = self.app.test_cli_runner().invoke(
+            args=['import', 'movies', path])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('line 3: missing release_date', result.output)
+        self.assertIn('Imported 2 movies', result.output)
+        with self.app.app_context():
+            self.assertEqual(Movies.query.count(), 3)
+
+    '''test importing roles referring to actors and movies by name'''
+    def test_import_roles_ndjson(self):
+        path = self.write_file('.ndjson', (
+            '{"actor": "Testing", "movie": "Testing", "role_name": "Lead"}\n'
+            '{"actor_id": 1, "movie_id": 1, "role_name": "Double"}\n'
+            '{"actor": "Nobody", "movie": "Testing", "role_name": "Extra"}\n'))
+
+        result = self.app.test_cli_runner().invoke(
+            args=['import', 'roles', path, '--chunk-size', '2'])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('line 3: unknown actor Nobody', result.output)
+        with self.app.app_context():
+            self.assertEqual(
+                [(role.actor_id, role.movie_id, role.role_name)
+                 for role in Roles.query.order_by(Roles.id)],
+                [(1, 1, 'Lead'), (1, 1, 'Double')])
+
+    '''test ndjson lines that are not objects or hold lists are skipped'''
+    def test_import_actors_ndjson_invalid_values(self):
+        path = self.write_file('.ndjson', (
+            '[1, 2]\n'
+            '5\n'
+            '{"name": "Ana", "age": 30, "gender": ["Female"]}\n'
+            '{"name": "Ben", "age": 31, "gender": "Male"}\n'))
+
+        result = self.app.test_cli_runner().invoke(
+            args=['import', 'actors', path])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('line 1: not a json object', result.output)
+        self.assertIn('line 2: not a json object', result.output)
+        self.assertIn('line 3: invalid gender', result.output)
+        self.assertIn('Imported 1 actors', result.output)
+        with self.app.app_context():
+            self.assertEqual(
+                [actor.name for actor in Actors.query.order_by(Actors.id)],
+                ['Testing', 'Ben'])
+
+    '''test a chunk the database rejects is reported and skipped'''
+    def test_import_skips_rejected_chunk(self):
+        path = self.write_file('.csv', (
+            'name,age,gender\n'
+            'Broken,30,Female\n'
+            'Second,31,Male\n'
+            'Third,32,Female\n'))
+        write = importer.insert_rows
+
+        def insert_rows(model, columns, rows):
+            if rows[0]['name'] == 'Broken':
+                raise IntegrityError('INSERT', None, Exception('rejected'))
+            write(model, columns, rows)
+
+        with patch('casting_agency.importer.insert_rows', insert_rows):
+            result = self.app.test_cli_runner().invoke(
+                args=['import', 'actors', path, '--chunk-size', '2'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('lines 2-3: chunk rejected, rejected', result.output)
+            self.assertIn('Imported 1 actors', result.output)
+            self.assertIn('2 invalid rows skipped', result.output)
+
+            result = self.app.test_cli_runner().invoke(
+                args=['import', 'actors', path, '--strict'])
+            self.assertEqual(result.exit_code, 1)
+
+        with self.app.app_context():
+            self.assertEqual(
+                [actor.name for actor in Actors.query.order_by(Actors.id)],
+                ['Testing', 'Third'])
+
+    '''test rows are written with COPY through a closed cursor'''
+    def test_import_copy_rows(self):
+        cursor = Mock()
+        connection = Mock(dialect=Mock(dbapi=sqlite3))
+        connection.connection.cursor.return_value = cursor
+        copied = []
+        cursor.copy_expert.side_effect = \
+            lambda statement, file: copied.append((statement, file.read()))
+
+        with self.app.app_context(), \
+                patch.object(db.session, 'connection', return_value=connection):
+            importer.copy_rows(Movies, ('name', 'genres'),
+                               [{'name': 'Up, again', 'genres': 'Animation'}])
+
+            self.assertEqual(copied, [(
+                'COPY movies (name, genres) FROM STDIN WITH (FORMAT csv)',
+                '"Up, again",Animation\r\n')])
+            cursor.close.assert_called_once_with()
+
+            cursor.copy_expert.side_effect = sqlite3.IntegrityError('conflict')
+            with self.assertRaises(IntegrityError):
+                importer.copy_rows(Movies, ('name',), [{'name': 'Up'}])
+            self.assertEqual(cursor.close.call_count, 2)
+
+    '''test writes are recorded in the audit log'''
+    @patch('casting_agency.auth.verify_decode_jwt',
+           return_value=dict(PRODUCER_PAYLOAD, sub='auth0|producer'))
+    def test_audit_log(self, mock):
+        self.app.config['AUDIT_ENABLED'] = True
+        self.client.post('/movies', json=self.test_movie, headers=TEST_HEADERS)
+        self.client.patch(
+            '/actors/1', json=self.edited_actor, headers=TEST_HEADERS)
+        self.client.delete('/movies/1', headers=TEST_HEADERS)
+
+        with self.app.app_context():
+            audit.flush()
+            self.assertEqual(
+                [(log.subject, log.action, log.entity, log.entity_id)
+                 for log in AuditLog.query.order_by(AuditLog.id)],
+                [('auth0|producer', 'created', 'movies', 2),
+                 ('auth0|producer', 'updated', 'actors', 1),
+                 ('auth0|producer', 'deleted', 'movies', 1)])
+
+        data = json.loads(
+            self.client.get('/metrics', headers=TEST_HEADERS).data)
+        self.assertEqual(data['audit']['written'], 3)
+        self.assertEqual(data['audit']['dropped'], 0)
+
+    '''test audit events are dropped and counted when the queue is full'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=PRODUCER_PAYLOAD)
+    def test_audit_log_overflow(self, mock):
+        self.app.config['AUDIT_ENABLED'] = True
+        audit_queue = self.app.extensions['audit']
+        audit_queue.queue.maxsize = 1
+        # keep the writer thread from starting and draining the queue
+        audit_queue.closed.set()
+
+        self.client.patch(
+            '/actors/1', json=self.edited_actor, headers=TEST_HEADERS)
+        self.client.patch(
+            '/actors/1', json=self.edited_actor, headers=TEST_HEADERS)
+
+        data = json.loads(
+            self.client.get('/metrics', headers=TEST_HEADERS).data)
+        self.assertEqual(data['audit']['enqueued'], 1)
+        self.assertEqual(data['audit']['dropped'], 1)
+
+    '''test the interval index finds every overlapping booking'''
+    def test_interval_index(self):
+        day = datetime.date(2021, 1, 1).toordinal
+        index = IntervalIndex([(day() + 0, day() + 100, 1),
+                               (day() + 10, day() + 12, 2)])
+        index.add(day() + 20, day() + 30, 3)
+        index.add(day() + 5, day() + 6, 4)
+
+        self.assertEqual(index.overlapping(day() + 11, day() + 25), [1, 2, 3])
+        self.assertEqual(index.overlapping(day() + 101, day() + 200), [])
+        self.assertEqual(index.overlapping(day() + 6, day() + 6), [1, 4])
+
+    '''test booking an actor and checking availability'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=PRODUCER_PAYLOAD)
+    def test_create_role_and_availability(self, mock):
+        role = {
+            'actor_id': 1,
+            'movie_id': 1,
+            'role_name': 'Lead',
+            'shoot_start': '2021-06-01',
+            'shoot_end': '2021-06-30'
+        }
+        res = self.client.post('/roles', json=role, headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+
+        res = self.client.get(
+            '/actors/1/availability?start=2021-06-30&end=2021-07-10',
+            headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['available'], False)
+        self.assertEqual(data['conflicts'][0]['role_name'], 'Lead')
+
+        res = self.client.get(
+            '/actors/1/availability?start=2021-07-01&end=2021-07-10',
+            headers=TEST_HEADERS)
+        self.assertEqual(json.loads(res.data)['available'], True)
+
+    '''test roles without shooting dates don't book the actor'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=PRODUCER_PAYLOAD)
+    def test_create_role_with_undated_role(self, mock):
+        role = {'actor_id': 1, 'movie_id': 1, 'role_name': 'Cameo'}
+        res = self.client.post('/roles', json=role, headers=TEST_HEADERS)
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client.get(
+            '/actors/1/availability?start=2021-06-01&end=2021-06-30',
+            headers=TEST_HEADERS)
+        data = json.loads(res.data)
+        self.assertEqual(data['available'], True)
+        self.assertEqual(data['conflicts'], [])
+
+        res = self.client.post(
+            '/roles',
+            json=dict(role, role_name='Lead', shoot_start='2021-06-01',
+                      shoot_end='2021-06-30'),
+            headers=TEST_HEADERS)
+        self.assertEqual(res.status_code, 200)
+
+    '''test booking an actor failed due to a scheduling conflict'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=PRODUCER_PAYLOAD)
+    def test_409_create_role_conflict(self, mock):
+        role = {
+            'actor_id': 1,
+            'movie_id': 1,
+            'role_name': 'Lead',
+            'shoot_start': '2021-06-01',
+            'shoot_end': '2021-06-30'
+        }
+        self.client.post('/roles', json=role, headers=TEST_HEADERS)
+        res = self.client.post(
+            '/roles',
+            json=dict(role, shoot_start='2021-06-15', shoot_end='2021-07-15'),
+            headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(len(data['conflicts']), 1)
+
+    '''test creating a role failed due to a body that is not an object'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=PRODUCER_PAYLOAD)
+    def test_422_create_role_invalid_body(self, mock):
+        res = self.client.post('/roles', json=[1], headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    '''test booking sees roles created outside this worker's index'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=PRODUCER_PAYLOAD)
+    def test_409_create_role_conflict_with_imported_role(self, mock):
+        res = self.client.get(
+            '/actors/1/availability?start=2021-06-01&end=2021-06-30',
+            headers=TEST_HEADERS)
+        self.assertEqual(json.loads(res.data)['available'], True)
+
+        # written behind the cached index, like the importer does
+        with self.app.app_context():
+            db.session.execute(Roles.__table__.insert(), [{
+                'actor_id': 1, 'movie_id': 1, 'role_name': 'Imported',
+                'shoot_start': datetime.date(2021, 6, 10),
+                'shoot_end': datetime.date(2021, 6, 20)}])
+            db.session.commit()
+
+        res = self.client.post('/roles', json={
+            'actor_id': 1,
+            'movie_id': 1,
+            'role_name': 'Lead',
+            'shoot_start': '2021-06-01',
+            'shoot_end': '2021-06-30'
+        }, headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(data['conflicts'][0]['role_name'], 'Imported')
+
+        self.app.config['SCHEDULE_INDEX_TTL'] = 0
+        res = self.client.get(
+            '/actors/1/availability?start=2021-06-01&end=2021-06-30',
+            headers=TEST_HEADERS)
+        self.assertEqual(json.loads(res.data)['available'], False)
+
+    '''test bookings of the same actor wait for each other'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=PRODUCER_PAYLOAD)
+    def test_create_role_waits_for_booking(self, mock):
+        responses = []
+
+        def book():
+            responses.append(self.client.post('/roles', json={
+                'actor_id': 1,
+                'movie_id': 1,
+                'role_name': 'Lead',
+                'shoot_start': '2021-06-01',
+                'shoot_end': '2021-06-30'
+            }, headers=TEST_HEADERS))
+
+        with self.app.app_context(), schedule.booking(1):
+            thread = threading.Thread(target=book)
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+        thread.join(5)
+
+        self.assertEqual(responses[0].status_code, 200)
+
+    '''test the schedule constraint command only acts on Postgres'''
+    def test_schedule_constraint_command(self):
+        result = self.app.test_cli_runner().invoke(
+            args=['schedule-constraint'])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Only Postgres supports the constraint', result.output)
+
+    '''test checking availability failed due to invalid dates'''
+    @patch('casting_agency.auth.verify_decode_jwt', return_value=ASSISTANT_PAYLOAD)
+    def test_400_availability_invalid_dates(self, mock):
+        res = self.client.get(
+            '/actors/1/availability?start=2021-07-10&end=2021-07-01',
+            headers=TEST_HEADERS)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":